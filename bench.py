@@ -0,0 +1,270 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+from client import BulletinClient, Directory, GroupPostEvent, MessageCache, PostEvent, ServerError, percentiles
+
+PRIVATE_GROUPS = ['Private1', 'Private2', 'Private3']
+DEFAULT_MIX = 'post=4,message=4,users=1,groups=1,grouppost=2,groupmessage=2,groupjoin=1'
+# post subjects carry the send time so every receiver can measure fan-out
+SUBJECT_PREFIX = 'bench@'
+
+class Stats:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.timeouts = 0
+        self.fanout = []
+
+    def record(self, op: str, seconds: float):
+        self.latencies.setdefault(op, []).append(seconds)
+
+    def error(self, op: str):
+        self.errors[op] = self.errors.get(op, 0) + 1
+
+def parse_mix(text: str) -> tuple:
+    ops = []
+    weights = []
+    for item in text.split(','):
+        op, _, weight = item.partition('=')
+        if op not in OPERATIONS:
+            raise SystemExit(f"unknown operation in mix: {op}")
+        ops.append(op)
+        weights.append(float(weight or 1))
+    return ops, weights
+
+class User:
+    # membership once every request sent so far is handled, so pipelined
+    # workers sharing this connection never act on the old one
+    def __init__(self, client: BulletinClient, name: str):
+        self.client = client
+        self.name = name
+        self.groups = set()
+        self.joined = True
+        self.posts = []
+        self.group_posts = {}
+
+    def subject(self) -> str:
+        return f"{SUBJECT_PREFIX}{RUN_TAG}:{time.monotonic_ns()}"
+
+class OperationFailed(Exception):
+    def __init__(self, op: str, error: Exception):
+        super().__init__(f"{op}: {error}")
+        self.op = op
+        self.error = error
+
+async def attempt(op: str, request):
+    # the reply to request, a server or connection error is reported under op
+    try:
+        return await request
+    except (ServerError, ConnectionError) as e:
+        raise OperationFailed(op, e) from e
+
+async def op_post(user: User):
+    if not user.joined:
+        return await op_join(user)
+    event = await attempt('post', user.client.post(user.subject(), 'x' * BODY_SIZE))
+    user.posts.append(event.id)
+    return 'post'
+
+async def op_grouppost(user: User):
+    if not user.groups:
+        return await op_groupjoin(user)
+    group_id = random.choice(sorted(user.groups))
+    event = await attempt('grouppost', user.client.group_post(group_id, user.subject(), 'x' * BODY_SIZE))
+    user.group_posts.setdefault(group_id, []).append(event.id)
+    return 'grouppost'
+
+async def op_message(user: User):
+    if not user.joined:
+        return await op_join(user)
+    if not user.posts:
+        return await op_post(user)
+    await attempt('message', user.client.message(random.choice(user.posts[-50:])))
+    return 'message'
+
+async def op_groupmessage(user: User):
+    choices = [group_id for group_id in user.groups if user.group_posts.get(group_id)]
+    if not choices:
+        return await op_grouppost(user)
+    group_id = random.choice(choices)
+    await attempt('groupmessage', user.client.group_message(group_id, random.choice(user.group_posts[group_id][-50:])))
+    return 'groupmessage'
+
+async def op_users(user: User):
+    if not user.joined:
+        return await op_join(user)
+    await attempt('users', user.client.users())
+    return 'users'
+
+async def op_groupusers(user: User):
+    if not user.groups:
+        return await op_groupjoin(user)
+    await attempt('groupusers', user.client.group_users(random.choice(sorted(user.groups))))
+    return 'groupusers'
+
+async def op_groups(user: User):
+    await attempt('groups', user.client.groups())
+    return 'groups'
+
+async def op_join(user: User):
+    # leave and rejoin the public group, timing each half separately
+    if user.joined:
+        user.joined = False
+        await attempt('leave', user.client.leave())
+        return 'leave'
+    user.joined = True
+    try:
+        await attempt('join', user.client.join(user.name))
+    except OperationFailed:
+        user.joined = False
+        raise
+    return 'join'
+
+async def op_groupjoin(user: User):
+    group_id = random.choice(PRIVATE_GROUPS)
+    if group_id in user.groups:
+        user.groups.discard(group_id)
+        await attempt('groupleave', user.client.group_leave(group_id))
+        return 'groupleave'
+    user.groups.add(group_id)
+    try:
+        await attempt('groupjoin', user.client.group_join(group_id, user.name))
+    except OperationFailed:
+        user.groups.discard(group_id)
+        raise
+    return 'groupjoin'
+
+OPERATIONS = {
+    'post': op_post,
+    'grouppost': op_grouppost,
+    'message': op_message,
+    'groupmessage': op_groupmessage,
+    'users': op_users,
+    'groupusers': op_groupusers,
+    'groups': op_groups,
+    'join': op_join,
+    'groupjoin': op_groupjoin,
+}
+BODY_SIZE = 64
+# keeps backlog posts left behind by earlier runs out of the fan-out numbers
+RUN_TAG = f"{os.getpid()}.{time.monotonic_ns()}"
+
+async def watch_events(client: BulletinClient, stats: Stats):
+    async for event in client:
+        if isinstance(event, (PostEvent, GroupPostEvent)) and event.subject.startswith(SUBJECT_PREFIX):
+            tag, _, sent = event.subject[len(SUBJECT_PREFIX):].partition(':')
+            if tag != RUN_TAG or not sent.isdigit():
+                continue
+            sent = int(sent)
+            stats.fanout.append((time.monotonic_ns() - sent) / 1e9)
+
+async def run_worker(user: User, ops: list, weights: list, deadline: float, stats: Stats):
+    while time.monotonic() < deadline and not user.client.closed:
+        operation = OPERATIONS[random.choices(ops, weights)[0]]
+        start = time.perf_counter()
+        try:
+            op = await operation(user)
+        except asyncio.TimeoutError:
+            stats.timeouts += 1
+            continue
+        except OperationFailed as e:
+            stats.error(e.op)
+            if isinstance(e.error, ConnectionError):
+                return
+            continue
+        stats.record(op, time.perf_counter() - start)
+
+async def run_user(args, index: int, ops: list, weights: list, start_at: float, deadline: float, stats: Stats, clients: list):
+    # no client-side caching, every operation is measured against the server
+    client = await BulletinClient.connect(
+        args.host, args.port, timeout=args.timeout, cache=MessageCache(0), directory=Directory(tracking=False), negotiate=args.extensions,
+    )
+    clients.append(client)
+    name = f"{args.prefix}{index}"
+    user = User(client, name)
+    await client.join(name)
+    watcher = asyncio.create_task(watch_events(client, stats))
+    await asyncio.sleep(max(0.0, start_at - time.monotonic()))
+    await asyncio.gather(*(run_worker(user, ops, weights, deadline, stats) for _ in range(args.pipeline)))
+    return watcher
+
+async def run(args) -> dict:
+    global BODY_SIZE
+    BODY_SIZE = args.body_size
+    ops, weights = parse_mix(args.mix)
+    stats = Stats()
+    clients = []
+    # connect and join everyone first so the measured window is steady state
+    start_at = time.monotonic() + args.warmup
+    deadline = start_at + args.duration
+    tasks = [asyncio.create_task(run_user(args, index, ops, weights, start_at, deadline, stats, clients)) for index in range(args.users)]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.monotonic() - start_at
+    failed = [result for result in results if isinstance(result, BaseException)]
+    await asyncio.sleep(args.drain)
+    for client in clients:
+        await client.close()
+    for result in results:
+        if isinstance(result, asyncio.Task):
+            result.cancel()
+    total = sum(len(values) for values in stats.latencies.values())
+    return {
+        'config': {
+            'host': args.host,
+            'port': args.port,
+            'users': args.users,
+            'pipeline': args.pipeline,
+            'duration': args.duration,
+            'warmup': args.warmup,
+            'mix': args.mix,
+            'body_size': args.body_size,
+        },
+        'elapsed_s': elapsed,
+        'sessions_failed': len(failed),
+        'session_errors': sorted({repr(result) for result in failed})[:10],
+        'ops_total': total,
+        'ops_per_sec': total / elapsed if elapsed > 0 else 0.0,
+        'ops': {op: dict(percentiles(values), ops_per_sec=len(values) / elapsed, errors=stats.errors.get(op, 0)) for op, values in sorted(stats.latencies.items())},
+        'errors': stats.errors,
+        'timeouts': stats.timeouts,
+        'fanout': percentiles(stats.fanout),
+        'frames': {
+            'malformed': sum(client.malformed for client in clients),
+            'discarded_bytes': sum(client.decoder.discarded for client in clients),
+        },
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the bulletin board protocol")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8083)
+    parser.add_argument('--users', type=int, default=20, help="simulated users, one connection each")
+    parser.add_argument('--pipeline', type=int, default=1, help="requests each user keeps in flight")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds to measure for")
+    parser.add_argument('--warmup', type=float, default=1.0, help="seconds allowed for connecting and joining")
+    parser.add_argument('--drain', type=float, default=0.5, help="seconds to keep reading broadcasts after the run")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f"weighted operations, default {DEFAULT_MIX}")
+    parser.add_argument('--body-size', type=int, default=64)
+    parser.add_argument('--timeout', type=float, default=10.0, help="per-request timeout in seconds")
+    parser.add_argument('--prefix', default=f"bench{os.getpid()}-", help="username prefix")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--extensions', action='store_true', help="negotiate batched, compressed frames with the server")
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,20 @@
+from __future__ import annotations
+
+import time
+
+# taken first so a one-shot command can time its whole run
+STARTED = time.perf_counter()
+
+import argparse
 import socket
+import struct
+import sys
 import threading
+from array import array
+from bisect import bisect_left, bisect_right, insort
 import os
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 
 JOIN = 0x01
 GROUP_JOIN = 0xA1
@@ -14,426 +28,3001 @@ MESSAGE = 0x05
 GROUP_MESSAGE = 0xA5
 EXIT = 0x06
 GROUPS = 0x07
+HELLO = 0x08
+BATCH = 0x09
 ERROR = 0xFF
 
+OPCODE_NAMES = {
+    JOIN: 'JOIN',
+    GROUP_JOIN: 'GROUP_JOIN',
+    POST: 'POST',
+    GROUP_POST: 'GROUP_POST',
+    USERS: 'USERS',
+    GROUP_USERS: 'GROUP_USERS',
+    LEAVE: 'LEAVE',
+    GROUP_LEAVE: 'GROUP_LEAVE',
+    MESSAGE: 'MESSAGE',
+    GROUP_MESSAGE: 'GROUP_MESSAGE',
+    EXIT: 'EXIT',
+    GROUPS: 'GROUPS',
+    HELLO: 'HELLO',
+    BATCH: 'BATCH',
+    ERROR: 'ERROR',
+}
+
+MAGIC = bytes([0xF0, 0x0D, 0xBE, 0xEF])
+HEADER_SIZE = 6
+MAX_FRAME_SIZE = HEADER_SIZE + 0xFFFF
+HEADER = struct.Struct('<4sHB')
+PUBLIC_GROUP = 'Public'
+MESSAGE_CACHE_BYTES = 4 * 1024 * 1024
+PREFETCH_CONCURRENCY = 4
+PREFETCH_QUEUE_SIZE = 256
+RECONNECT_BASE_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+OFFLINE_QUEUE_SIZE = 256
+# seconds before an unanswered request fails with TimeoutError
+REQUEST_TIMEOUT = 30.0
+EXPIRE_INTERVAL = 1.0
+OUTBOX_SIZE = 1024
+# full outbox: 'block', 'drop-oldest' or 'raise' SendQueueFull
+OUTBOX_POLICY = 'raise'
+SUBSCRIBER_QUEUE_SIZE = 1024
+# slow subscriber: 'drop-oldest', 'drop-newest' or 'close'
+SUBSCRIBER_POLICY = 'drop-oldest'
+IOV_MAX = 1024
+# protocol extensions offered in HELLO, see protocol.txt
+EXTENSIONS = ('batch', 'zlib')
+BATCH_ZLIB = 0x01
+# a BATCH payload is one flags byte and the frames without their magic numbers
+MAX_BATCH_BODY = MAX_FRAME_SIZE - HEADER_SIZE - 2
+COMPRESS_MIN_SIZE = 512
+COMPRESS_LEVEL = 1
+MAX_INFLATED_SIZE = 1024 * 1024
+RENDER_FPS = 30
+# broadcasts printed per frame before the rest are only counted
+RENDER_SUMMARY_AFTER = 50
+
 thread_stop = threading.Event()
-print_lock = threading.Lock()
-active_connection = False
-sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+local_state = threading.local()
+send_lock = threading.RLock()
+# wake() writes here so the reader notices new sockets and shutdown
+wakeup_reader = wakeup_writer = None
+# the writer waits on this for any outbox to have frames
+send_ready = threading.Condition()
+ready_outboxes = deque()
+# send queue overflow policy for connections opened from now on
+outbox_policy = OUTBOX_POLICY
+# groups --prefetch enables on every connection
+prefetch_groups = set()
+archive = None
+# hot paths only test this for None
+metrics = None
+# set by --script: everything goes to stdout as one JSON object per line
+json_output = False
+
+class FrameDecoder:
+    # reads land in one preallocated buffer that can hold many frames
+    def __init__(self, size: int = 4 * MAX_FRAME_SIZE):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.discarded = 0
+
+    def recv_into(self, sock: socket.socket) -> int:
+        if len(self.buffer) - self.end < MAX_FRAME_SIZE:
+            self._reserve(MAX_FRAME_SIZE)
+        count = sock.recv_into(self.view[self.end:])
+        self.end += count
+        return count
+
+    def feed(self, data: bytes):
+        size = len(data)
+        if len(self.buffer) - self.end < size:
+            self._reserve(size)
+        self.view[self.end:self.end+size] = data
+        self.end += size
+
+    def frames(self):
+        buffer = self.buffer
+        while self.end - self.start >= HEADER_SIZE:
+            start = self.start
+            if not buffer.startswith(MAGIC, start):
+                # lost sync, skip ahead to the next magic number
+                index = buffer.find(MAGIC, start + 1, self.end)
+                if index == -1:
+                    index = self.end - len(MAGIC) + 1
+                self.discarded += index - start
+                self.start = index
+                continue
+            length = buffer[start+4] | buffer[start+5] << 8
+            if length == 0:
+                self.discarded += 1
+                self.start = start + 1
+                continue
+            end = start + HEADER_SIZE + length
+            if end > self.end:
+                break
+            self.start = end
+            if buffer[start+HEADER_SIZE] != BATCH:
+                yield bytes(self.view[start:end])
+                continue
+            frames = unbatch(self.view[start:end])
+            if frames is None:
+                self.discarded += end - start
+                continue
+            yield from frames
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def _reserve(self, size: int):
+        pending = self.end - self.start
+        if pending + size > len(self.buffer):
+            buffer = bytearray(max(2 * len(self.buffer), pending + size))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.view.release()
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        elif self.start:
+            self.view[:pending] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+def wake():
+    if wakeup_writer is None:
+        return
+    try:
+        wakeup_writer.send(b'\0')
+    except (BlockingIOError, OSError):
+        pass
 
 def await_message():
-    global sock
-    global active_connection
+    global wakeup_reader, wakeup_writer
+    import selectors
+    wakeup_reader, wakeup_writer = socket.socketpair()
+    wakeup_writer.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(wakeup_reader, selectors.EVENT_READ)
+    watched = {}
+    watch(selector, watched)
+    next_expiry = time.perf_counter() + EXPIRE_INTERVAL
     while not thread_stop.is_set():
-        if active_connection:
-            incoming = sock.recv(1024)
-            parse_received_message(incoming)
+        # the timeout also paces request expiry
+        for key, _ in selector.select(EXPIRE_INTERVAL):
+            connection = key.data
+            if connection is None:
+                wakeup_reader.recv(4096)
+                watch(selector, watched)
+                continue
+            decoder = connection.decoder
+            try:
+                count = decoder.recv_into(key.fileobj)
+            except OSError:
+                count = 0
+            if count == 0:
+                selector.unregister(key.fileobj)
+                del watched[key.fileobj]
+                connection.lost(key.fileobj)
+                continue
+            if metrics is None:
+                for frame in decoder.frames():
+                    parse_received_message(frame, connection)
+            else:
+                metrics.observe('recv_bytes', count)
+                discarded = decoder.discarded
+                for frame in decoder.frames():
+                    started = time.perf_counter()
+                    parse_received_message(frame, connection)
+                    metrics.received(frame[HEADER_SIZE], time.perf_counter() - started)
+                if decoder.discarded != discarded:
+                    metrics.count('discarded_bytes', value=decoder.discarded - discarded)
+            if connection.prefetcher.queue:
+                connection.prefetcher.pump()
+        if archive is not None:
+            archive.flush()
+        now = time.perf_counter()
+        if now >= next_expiry:
+            next_expiry = now + EXPIRE_INTERVAL
+            with send_lock:
+                for connection in watched.values():
+                    if connection.pending.queue:
+                        connection.pending.expire(now)
+    selector.close()
+
+def watch(selector, watched: dict):
+    # only run when woken, so idle connections cost nothing per frame
+    import selectors
+    live = {connection.sock: connection for connection in tuple(connections.values()) if connection.active}
+    for sock in [sock for sock, connection in watched.items() if live.get(sock) is not connection]:
+        selector.unregister(sock)
+        del watched[sock]
+    for sock, connection in live.items():
+        if sock not in watched:
+            connection.decoder = FrameDecoder(MAX_FRAME_SIZE)
+            selector.register(sock, selectors.EVENT_READ, connection)
+            watched[sock] = connection
 
 message_thread = threading.Thread(target=await_message, daemon=True)
 
-def join(username: str):
-    body = bytes([JOIN])
-    username_bytes = username.encode('utf-8')
-    body += len(username_bytes).to_bytes(2, 'little') + username_bytes
-    send_message(body)
-
-def group_join(group_id: str, username: str):
-    body = bytes([GROUP_JOIN])
-    group_bytes = group_id.encode('utf-8')
-    body += len(group_bytes).to_bytes(2, 'little') + group_bytes
-    username_bytes = username.encode('utf-8')
-    body += len(username_bytes).to_bytes(2, 'little') + username_bytes
-    send_message(body)
-
-def post(subject: str, message: str):
-    body = bytes([POST])
-    subject_bytes = subject.encode('utf-8')
-    message_bytes = message.encode('utf-8')
-    body += len(subject_bytes).to_bytes(2, 'little') + subject_bytes
-    body += len(message_bytes).to_bytes(2, 'little') + message_bytes
-    send_message(body)
-
-def group_post(group_id: str, subject: str, message: str):
-    body = bytes([GROUP_POST])
-    subject_bytes = subject.encode('utf-8')
-    message_bytes = message.encode('utf-8')
-    group_bytes = group_id.encode('utf-8')
-    body += len(group_bytes).to_bytes(2, 'little') + group_bytes
-    body += len(subject_bytes).to_bytes(2, 'little') + subject_bytes
-    body += len(message_bytes).to_bytes(2, 'little') + message_bytes
-    send_message(body)
-
-def users():
-    body = bytes([USERS])
-    send_message(body)
-
-def group_users(group_id: str):
-    body = bytes([GROUP_USERS])
-    group_bytes = group_id.encode('utf-8')
-    body += len(group_bytes).to_bytes(2, 'little') + group_bytes
-    send_message(body)
-
-def leave():
-    body = bytes([LEAVE])
-    send_message(body)
-
-def group_leave(group_id: str):
-    body = bytes([GROUP_LEAVE])
-    group_bytes = group_id.encode('utf-8')
-    body += len(group_bytes).to_bytes(2, 'little') + group_bytes
-    send_message(body)
-
-def message_command(id: str):
-    body = bytes([MESSAGE])
-    id_bytes = id.encode('utf-8')
-    body += len(id_bytes).to_bytes(2, 'little') + id_bytes
-    send_message(body)
-
-def group_message_command(group_id: str, msg_id: str):
-    body = bytes([GROUP_MESSAGE])
-    group_bytes = group_id.encode('utf-8')
-    body += len(group_bytes).to_bytes(2, 'little') + group_bytes
-    id_bytes = msg_id.encode('utf-8')
-    body += len(id_bytes).to_bytes(2, 'little') + id_bytes
-    send_message(body)
-
-def groups():
-    body = bytes([GROUPS])
-    send_message(body)
+class Connection:
+    # One named server session; all of them share the reader and writer threads.
+    def __init__(self, name: str):
+        self.name = name
+        self.sock = None
+        self.active = False
+        # where to reconnect to after the connection drops, None once closed
+        self.address = None
+        # host:port of the last server, kept after closing for the archive
+        self.server = None
+        self.extensions = frozenset()
+        self.offline_requests = deque()
+        self.decoder = None
+        self.outbox = Outbox(self)
+        self.pending = PendingRequests()
+        self.message_cache = MessageCache()
+        self.header_index = HeaderIndex()
+        self.directory = Directory()
+        self.prefetcher = Prefetcher(self)
+        self.prefetcher.groups.update(prefetch_groups)
+        self.subscriptions = Subscriptions()
+        self.pending.on_complete = self.directory.finished
 
-def exit_command():
-    body = bytes([EXIT])
-    send_message(body)
-
-def send_message(body: bytes):
-    global sock
-    global active_connection
-    if active_connection:
-        prefix = bytes([0xF0, 0x0D, 0xBE, 0xEF]) + len(body).to_bytes(2, 'little') + body
+    def open(self, ip: str, port: int):
+        new_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            sock.sendall(prefix)
-        except:
-            pass
+            new_sock.connect((ip, port))
+        except OSError:
+            new_sock.close()
+            raise
+        self.end()
+        self.pending.usernames.clear()
+        self.forget_server()
+        self.start(new_sock, (ip, port))
 
-def parse_received_message(message: bytes):
-    if len(message) < 7 or message[0:4] != bytes([0xF0, 0x0D, 0xBE, 0xEF]) or int.from_bytes(message[4:6], 'little') + 6 != len(message):
-        return
-    op_code = message[6]
-    if op_code == ERROR:
-        error_length = int.from_bytes(message[7:9], 'little')
-        error_message = message[9:9+error_length].decode('utf-8')
-        # print in red text
-        with print_lock:
-            print(f"\n\033[91mError from server: {error_message}\033[0m", end='', flush=True)
-    elif op_code == USERS:
-        user_count = int.from_bytes(message[7:9], 'little')
-        users = []
-        index = 9
-        for _ in range(user_count):
-            username_length = int.from_bytes(message[index:index+2], 'little')
-            index += 2
-            username = message[index:index+username_length].decode('utf-8')
-            index += username_length
-            users.append(username)
-        with print_lock:
-            print(f"\nActive users: \n{'\n'.join(users)}", end='', flush=True)
-    elif op_code == GROUP_USERS:
-        user_count = int.from_bytes(message[7:9], 'little')
-        users = []
-        index = 9
-        for _ in range(user_count):
-            username_length = int.from_bytes(message[index:index+2], 'little')
-            index += 2
-            username = message[index:index+username_length].decode('utf-8')
-            index += username_length
-            users.append(username)
-        group_id_length = int.from_bytes(message[index:index+2], 'little')
-        index += 2
-        group_id = message[index:index+group_id_length].decode('utf-8')
-        index += group_id_length
-        group_name_length = int.from_bytes(message[index:index+2], 'little')
-        index += 2
-        group_name = message[index:index+group_name_length].decode('utf-8')
-        with print_lock:
-            print(f"\nActive users of \"{group_name}\" (id: {group_id}): \n{'\n'.join(users)}", end='', flush=True)
-    elif op_code == POST:
-        id_length = int.from_bytes(message[7:9], 'little')
-        id = message[9:9+id_length].decode('utf-8')
-        sender_length = int.from_bytes(message[9+id_length:11+id_length], 'little')
-        sender = message[11+id_length:11+id_length+sender_length].decode('utf-8')
-        date_length = int.from_bytes(message[11+id_length+sender_length:13+id_length+sender_length], 'little')
-        date = message[13+id_length+sender_length:13+id_length+sender_length+date_length].decode('utf-8')
-        subject_length = int.from_bytes(message[13+id_length+sender_length+date_length:15+id_length+sender_length+date_length], 'little')
-        subject = message[15+id_length+sender_length+date_length:15+id_length+sender_length+date_length+subject_length].decode('utf-8')
-        with print_lock:
-            print(f"\nID: {id}\nFrom: {sender}\nDate: {date}\nSubject: {subject}", end='', flush=True)
-    elif op_code == GROUP_POST:
-        id_length = int.from_bytes(message[7:9], 'little')
-        id = message[9:9+id_length].decode('utf-8')
-        sender_length = int.from_bytes(message[9+id_length:11+id_length], 'little')
-        sender = message[11+id_length:11+id_length+sender_length].decode('utf-8')
-        date_length = int.from_bytes(message[11+id_length+sender_length:13+id_length+sender_length], 'little')
-        date = message[13+id_length+sender_length:13+id_length+sender_length+date_length].decode('utf-8')
-        subject_length = int.from_bytes(message[13+id_length+sender_length+date_length:15+id_length+sender_length+date_length], 'little')
-        subject = message[15+id_length+sender_length+date_length:15+id_length+sender_length+date_length+subject_length].decode('utf-8')
-        group_id_length = int.from_bytes(message[15+id_length+sender_length+date_length+subject_length:17+id_length+sender_length+date_length+subject_length], 'little')
-        group_id = message[17+id_length+sender_length+date_length+subject_length:17+id_length+sender_length+date_length+subject_length+group_id_length].decode('utf-8')
-        group_name_length = int.from_bytes(message[17+id_length+sender_length+date_length+subject_length+group_id_length:19+id_length+sender_length+date_length+subject_length+group_id_length], 'little')
-        group_name = message[19+id_length+sender_length+date_length+subject_length+group_id_length:19+id_length+sender_length+date_length+subject_length+group_id_length+group_name_length].decode('utf-8')
-        with print_lock:
-            print(f"\nFROM Group \"{group_name}\" (id: {group_id}):", end='', flush=True)
-            print(f"\nID: {id}\nFrom: {sender}\nDate: {date}\nSubject: {subject}", end='', flush=True)
-    elif op_code == JOIN:
-        username_length = int.from_bytes(message[7:9], 'little')
-        username = message[9:9+username_length].decode('utf-8')
-        with print_lock:
-            print(f"\nUser {username} has joined the chat.", end='', flush=True)
-    elif op_code == GROUP_JOIN:
-        username_length = int.from_bytes(message[7:9], 'little')
-        username = message[9:9+username_length].decode('utf-8')
-        group_id_length = int.from_bytes(message[9+username_length:11+username_length], 'little')
-        group_id = message[11+username_length:11+username_length+group_id_length].decode('utf-8')
-        group_name_length = int.from_bytes(message[11+username_length+group_id_length:13+username_length+group_id_length], 'little')
-        group_name = message[13+username_length+group_id_length:13+username_length+group_id_length+group_name_length].decode('utf-8')
-        with print_lock:
-            print(f"\nUser {username} has joined group \"{group_name}\" (id: {group_id})", end='', flush=True)
-    elif op_code == LEAVE:
-        username_length = int.from_bytes(message[7:9], 'little')
-        username = message[9:9+username_length].decode('utf-8')
-        with print_lock:
-            print(f"\nUser {username} has left the chat.", end='', flush=True)
-    elif op_code == GROUP_LEAVE:
-        username_length = int.from_bytes(message[7:9], 'little')
-        username = message[9:9+username_length].decode('utf-8')
-        group_id_length = int.from_bytes(message[9+username_length:11+username_length], 'little')
-        group_id = message[11+username_length:11+username_length+group_id_length].decode('utf-8')
-        group_name_length = int.from_bytes(message[11+username_length+group_id_length:13+username_length+group_id_length], 'little')
-        group_name = message[13+username_length+group_id_length:13+username_length+group_id_length+group_name_length].decode('utf-8')
-        with print_lock:
-            print(f"\nUser {username} has left group \"{group_name}\" (id: {group_id})", end='', flush=True)
-    elif op_code == MESSAGE:
-        body_length = int.from_bytes(message[7:9], 'little')
-        body = message[9:9+body_length].decode('utf-8')
-        with print_lock:
-            print(f"\n--------------------------------------\n{body}\n--------------------------------------", end='', flush=True)
-    elif op_code == GROUPS:
-        group_count = int.from_bytes(message[7:9], 'little')
-        groups = []
-        index = 9
-        for _ in range(group_count):
-            group_id_length = int.from_bytes(message[index:index+2], 'little')
-            index += 2
-            group_id = message[index:index+group_id_length].decode('utf-8')
-            index += group_id_length
-            group_name_length = int.from_bytes(message[index:index+2], 'little')
-            index += 2
-            group_name = message[index:index+group_name_length].decode('utf-8')
-            index += group_name_length
-            groups.append(f"\"{group_name}\" (id: {group_id})")
-        with print_lock:
-            print(f"\nActive groups: \n{'\n'.join(groups)}", end='', flush=True)
-    with print_lock:
-        print("\n> ", end='', flush=True)
+    def forget_server(self):
+        # ids restart at msg1 when the server does
+        self.message_cache.clear()
+        self.header_index = HeaderIndex()
+        self.directory.clear()
+        self.prefetcher.forget()
 
-def parse_command(command: str):
-    global message_thread
-    global sock
-    global active_connection
-    if command.find('"') != -1:
-        parts = []
-        temp = ''
-        in_quotes = False
-        for char in command:
-            if char == '"':
-                in_quotes = not in_quotes
-                if not in_quotes:
-                    parts.append(temp)
-                    temp = ''
-            elif char == ' ' and not in_quotes:
-                if temp:
-                    parts.append(temp)
-                    temp = ''
-            else:
-                temp += char
-        if temp:
-            parts.append(temp)
-        tokens = parts
-        # if no second quote, raise invalid command
-        if in_quotes:
-            with print_lock:
-                print("\nInvalid command: unmatched quotes.\n> ", end='', flush=True)
+    def start(self, new_sock: socket.socket, address: tuple):
+        with send_lock:
+            self.sock = new_sock
+            self.address = address
+            self.server = f"{address[0]}:{address[1]}"
+            self.active = True
+            self.extensions = frozenset()
+            # before wake(), so the reader finds the new socket
+            connections[self.name] = self
+            # sent before anything else so replies from here on can be batched
+            future = self.request(HELLO, ','.join(EXTENSIONS), internal=True)
+        future.add_done_callback(lambda future: self.accept_extensions(new_sock, future))
+        if not writer_thread.is_alive():
+            writer_thread.start()
+        wake()
+
+    def accept_extensions(self, session_sock: socket.socket, future: Future):
+        # legacy servers ignore HELLO, the barrier behind it then fails the request
+        if future.exception() is not None:
             return
-    else:
-        tokens = command.strip().split(' ')
-    if not tokens:
-        return
-    cmd = tokens[0].lower()
-    if cmd == 'connect':
-        if len(tokens) != 3:
-            with print_lock:
-                print("\nUsage: connect <ip> <port>\n> ", end='', flush=True)
+        with send_lock:
+            if session_sock is self.sock:
+                self.extensions = frozenset(future.result().features.split(',')) & frozenset(EXTENSIONS)
+
+    def lost(self, lost_sock: socket.socket):
+        with send_lock:
+            lost_sock.close()
+            if lost_sock is not self.sock or not self.active:
+                return
+            self.active = False
+            self.outbox.clear()
+            self.pending.fail_all(ConnectionError("connection lost"))
+            # broadcasts were missed while the connection was down
+            self.directory.forget()
+            address = self.address
+        wake()
+        if thread_stop.is_set():
             return
-        if active_connection:
-            with print_lock:
-                print("\nAlready connected to a server.\n> ", end='', flush=True)
+        if address is None:
+            notify(f"\n{self.prefix()}Disconnected from server.", 'disconnected', **self.tag())
             return
-        ip = tokens[1]
-        try:
-            port = int(tokens[2])
-        except ValueError:
-            with print_lock:
-                print("\nPort must be an integer.\n> ", end='', flush=True)
+        notify(f"\n{self.prefix()}Connection to {address[0]}:{address[1]} lost, reconnecting...", 'reconnecting',
+               host=address[0], port=address[1], **self.tag())
+        threading.Thread(target=self.reconnect, args=(address,), daemon=True).start()
+
+    def reconnect(self, address: tuple):
+        import random
+        attempt = 0
+        while not thread_stop.is_set():
+            # jitter so a server bounce isn't met by every client at once
+            delay = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.0)
+            if thread_stop.wait(delay):
+                return
+            attempt += 1
+            if self.address != address or self.active:
+                return
+            try:
+                new_sock = socket.create_connection(address, timeout=RECONNECT_MAX_DELAY)
+                new_sock.settimeout(None)
+            except OSError:
+                continue
+            with send_lock:
+                if self.address != address or self.active:
+                    new_sock.close()
+                    return
+                if metrics is not None:
+                    metrics.count('reconnects')
+                memberships = self.pending.memberships()
+                # the server may have restarted
+                self.forget_server()
+                self.start(new_sock, address)
+                # rejoin first so the queued requests run with the same memberships
+                for group_id, username in memberships:
+                    if group_id is None:
+                        future = self.request(JOIN, username, internal=True)
+                    else:
+                        future = self.request(GROUP_JOIN, group_id, username, internal=True)
+                    future.add_done_callback(lambda future, group_id=group_id: self.report_rejoin(group_id, future))
+                while self.offline_requests:
+                    opcode, fields, internal, future = self.offline_requests.popleft()
+                    self.request(opcode, *fields, internal=internal, future=future)
+            notify(f"\n{self.prefix()}Reconnected to {address[0]}:{address[1]}", 'reconnected',
+                   host=address[0], port=address[1], **self.tag())
             return
+
+    def report_rejoin(self, group_id: str, future: Future):
+        error = future.exception()
+        if error is not None:
+            notify(f"\n\033[91m{self.prefix()}Could not rejoin {group_id or PUBLIC_GROUP}: {error}\033[0m", 'rejoin_failed',
+                   group=group_id or PUBLIC_GROUP, error=str(error), **self.tag())
+
+    def end(self):
+        with send_lock:
+            self.address = None
+            while self.offline_requests:
+                self.offline_requests.popleft()[3].set_exception(ConnectionError("not connected"))
+
+    def close(self):
+        self.end()
+        self.send(encode_frame(EXIT))
+
+    def request(self, opcode: int, *fields: str, internal: bool = False, future: Future = None, block: bool = True) -> Future:
+        from concurrent.futures import Future
+        frame = encode_frame(opcode, *fields)
+        if future is None:
+            future = Future()
+        frames = 2 if opcode in BARRIERED else 1
+        if block:
+            self.outbox.reserve(frames)
+        with send_lock:
+            if not self.active:
+                if self.address is None:
+                    future.set_exception(ConnectionError("not connected"))
+                    return future
+                if len(self.offline_requests) == OFFLINE_QUEUE_SIZE:
+                    self.offline_requests.popleft()[3].set_exception(ConnectionError("dropped while reconnecting"))
+                self.offline_requests.append((opcode, fields, internal, future))
+                return future
+            self.outbox.check(frames, strict=not block)
+            self.send(frame, self.pending.track(opcode, fields, future, internal))
+            if opcode in BARRIERED:
+                self.send(encode_frame(GROUPS), self.pending.track(GROUPS, (), Future(), internal=True))
+        return future
+
+    def send(self, frame: bytes, entry=None):
+        if self.active:
+            self.outbox.put(frame, entry)
+
+    def write(self, items: list):
+        current = self.sock
+        frames = [frame for frame, _ in items]
+        if metrics is not None:
+            metrics.observe('outbox_depth', len(frames))
+            for frame in frames:
+                metrics.count('frames_out', frame[HEADER_SIZE])
+        if 'batch' in self.extensions:
+            frames = pack_batches(frames, 'zlib' in self.extensions)
+        if self.active:
+            started = time.perf_counter()
+            try:
+                send_frames(current, frames)
+            except OSError:
+                self.lost(current)
+            if metrics is not None:
+                metrics.observe('send_seconds', time.perf_counter() - started)
+
+    def archive_group(self, group_id: str) -> str:
+        # every server numbers its messages from msg1
+        return f"{self.server}/{group_id}"
+
+    def stored_body(self, group_id: str, msg_id: str):
+        body = self.message_cache.get((group_id, msg_id))
+        if body is None and archive is not None:
+            body = archive.body(self.archive_group(group_id), msg_id)
+            if body is not None:
+                self.message_cache.put((group_id, msg_id), body)
+        return body
+
+    def has_body(self, group_id: str, msg_id: str) -> bool:
+        if (group_id, msg_id) in self.message_cache.entries:
+            return True
+        return archive is not None and archive.has_body(self.archive_group(group_id), msg_id)
+
+    def prefix(self) -> str:
+        return f"[{self.name}] " if len(connections) > 1 else ''
+
+    def tag(self) -> dict:
+        return {'connection': self.name} if len(connections) > 1 else {}
+
+@contextmanager
+def addressed(connection: Connection):
+    # commands run by this thread inside the block go to this connection
+    outer = getattr(local_state, 'connection', None)
+    local_state.connection = connection
+    try:
+        yield connection
+    finally:
+        local_state.connection = outer
+
+def target() -> Connection:
+    return getattr(local_state, 'connection', None) or current
+
+def promote(connection: Connection):
+    # a new connection takes over when the current one is not connected
+    global current
+    if current.address is None:
+        current = connection
+
+def encode_frame(opcode: int, *fields: str) -> bytearray:
+    return pack_frame(opcode, [field.encode('utf-8') for field in fields])
+
+def pack_frame(opcode: int, parts: list) -> bytearray:
+    # parts are encoded strings, or ints for list counts
+    size = HEADER.size + 2 * len(parts) + sum(len(part) for part in parts if type(part) is not int)
+    if size > MAX_FRAME_SIZE:
+        raise ValueError(f"message too long ({size - HEADER_SIZE} bytes, max {MAX_FRAME_SIZE - HEADER_SIZE})")
+    frame = bytearray(size)
+    HEADER.pack_into(frame, 0, MAGIC, size - HEADER_SIZE, opcode)
+    index = HEADER.size
+    for part in parts:
+        if type(part) is int:
+            frame[index] = part & 0xFF
+            frame[index+1] = part >> 8
+            index += 2
+            continue
+        length = len(part)
+        frame[index] = length & 0xFF
+        frame[index+1] = length >> 8
+        frame[index+2:index+2+length] = part
+        index += 2 + length
+    return frame
+
+def pack_batches(frames: list, compress: bool) -> list:
+    batches = []
+    group = []
+    size = 0
+    for frame in frames:
+        length = len(frame) - len(MAGIC)
+        if group and size + length > MAX_BATCH_BODY:
+            batches.append(pack_batch(group, compress))
+            group = []
+            size = 0
+        group.append(frame)
+        size += length
+    if group:
+        batches.append(pack_batch(group, compress))
+    return batches
+
+def pack_batch(frames: list, compress: bool) -> bytes:
+    size = sum(len(frame) for frame in frames) - len(MAGIC) * len(frames)
+    if compress and size >= COMPRESS_MIN_SIZE:
+        import zlib
+        packed = zlib.compress(b''.join(memoryview(frame)[len(MAGIC):] for frame in frames), COMPRESS_LEVEL)
+        if len(packed) < size and len(packed) <= MAX_BATCH_BODY:
+            return batch_frame(BATCH_ZLIB, packed)
+    if len(frames) == 1:
+        return frames[0]
+    return batch_frame(0, b''.join(memoryview(frame)[len(MAGIC):] for frame in frames))
+
+def batch_frame(flags: int, body: bytes) -> bytearray:
+    frame = bytearray(HEADER.size + 1 + len(body))
+    HEADER.pack_into(frame, 0, MAGIC, len(frame) - HEADER_SIZE, BATCH)
+    frame[HEADER.size] = flags
+    frame[HEADER.size+1:] = body
+    return frame
+
+def unbatch(frame: bytes):
+    # the frames carried by a BATCH frame, None if it is malformed
+    if len(frame) <= HEADER.size:
+        return None
+    flags = frame[HEADER.size]
+    if flags & ~BATCH_ZLIB:
+        return None
+    body = memoryview(frame)[HEADER.size+1:]
+    if flags & BATCH_ZLIB:
+        import zlib
+        inflater = zlib.decompressobj()
         try:
-            sock.connect((ip, port))
-            with print_lock:
-                print(f"\nConnected to {ip}:{port}\n> ", end='', flush=True)
-        except Exception as e:
-            with print_lock:
-                print(f"\nFailed to connect to {ip}:{port} - {e}\n> ", end='', flush=True)
-        active_connection = True
-        message_thread.start()
-    elif cmd == 'join':
-        if not active_connection:
-            with print_lock:
-                print("\nNot connected to any server. Use 'connect <ip> <port>' first.\n> ", end='', flush=True)
-            return
-        if len(tokens) != 2:
-            with print_lock:
-                print("\nUsage: join <username>\n> ", end='', flush=True)
-            return
-        join(tokens[1])
-        with print_lock:
-            print("\n> ", end='', flush=True)
-    elif cmd == 'post':
-        if not active_connection:
-            with print_lock:
-                print("\nNot connected to any server. Use 'connect <ip> <port>' first.\n> ", end='', flush=True)
-            return
-        if len(tokens) != 3:
-            with print_lock:
-                print("\nUsage: post <subject> <message>\n> ", end='', flush=True)
-            return
-        subject = tokens[1]
-        message = ' '.join(tokens[2:])
-        post(subject, message)
-    elif cmd == 'users':
-        if not active_connection:
-            with print_lock:
-                print("\nNot connected to any server. Use 'connect <ip> <port>' first.\n> ", end='', flush=True)
-            return
-        users()
-    elif cmd == 'leave':
-        if not active_connection:
-            with print_lock:
-                print("\nNot connected to any server. Use 'connect <ip> <port>' first.\n> ", end='', flush=True)
+            body = inflater.decompress(body, MAX_INFLATED_SIZE)
+        except zlib.error:
+            return None
+        if not inflater.eof or inflater.unconsumed_tail:
+            return None
+    frames = []
+    index = 0
+    while index < len(body):
+        if index + 3 > len(body):
+            return None
+        end = index + 2 + (body[index] | body[index+1] << 8)
+        # every frame has an opcode, and batches do not nest
+        if end == index + 2 or end > len(body) or body[index+2] == BATCH:
+            return None
+        frames.append(MAGIC + body[index:end])
+        index = end
+    return frames
+
+def join(username: str) -> Future:
+    return send_request(JOIN, username)
+
+def group_join(group_id: str, username: str) -> Future:
+    return send_request(GROUP_JOIN, group_id, username)
+
+def post(subject: str, message: str) -> Future:
+    return send_request(POST, subject, message)
+
+def group_post(group_id: str, subject: str, message: str) -> Future:
+    return send_request(GROUP_POST, group_id, subject, message)
+
+def users() -> Future:
+    return known_users(PUBLIC_GROUP) or send_request(USERS)
+
+def group_users(group_id: str) -> Future:
+    return known_users(group_id) or send_request(GROUP_USERS, group_id)
+
+def leave() -> Future:
+    return send_request(LEAVE)
+
+def group_leave(group_id: str) -> Future:
+    return send_request(GROUP_LEAVE, group_id)
+
+def message_command(id: str) -> Future:
+    return cached_request(PUBLIC_GROUP, id) or send_request(MESSAGE, id)
+
+def group_message_command(group_id: str, msg_id: str) -> Future:
+    return cached_request(group_id, msg_id) or send_request(GROUP_MESSAGE, group_id, msg_id)
+
+def stored_body(group_id: str, msg_id: str):
+    return target().stored_body(group_id, msg_id)
+
+def has_body(group_id: str, msg_id: str) -> bool:
+    return target().has_body(group_id, msg_id)
+
+def cached_request(group_id: str, msg_id: str):
+    body = stored_body(group_id, msg_id)
+    if body is None:
+        return None
+    return answered(MessageEvent(body))
+
+def known_users(group_id: str):
+    reply = target().directory.users(group_id)
+    if reply is None:
+        return None
+    return answered(reply)
+
+def answered(reply) -> Future:
+    from concurrent.futures import Future
+    future = Future()
+    future.set_result(reply)
+    future.local = True
+    return future
+
+def groups() -> Future:
+    return send_request(GROUPS)
+
+def subscribe(opcodes=None, group_id: str = None, sender: str = None, size: int = SUBSCRIBER_QUEUE_SIZE, policy: str = SUBSCRIBER_POLICY):
+    return target().subscriptions.subscribe(opcodes, group_id, sender, size, policy)
+
+def exit_command():
+    for connection in tuple(connections.values()):
+        connection.close()
+        connection.subscriptions.close()
+
+def send_request(opcode: int, *fields: str, internal: bool = False, future: Future = None) -> Future:
+    return target().request(opcode, *fields, internal=internal, future=future)
+
+def send_frames(sock: socket.socket, frames: list):
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(frames))
+        return
+    buffers = [memoryview(frame) for frame in frames]
+    index = 0
+    while index < len(buffers):
+        sent = sock.sendmsg(buffers[index:index+IOV_MAX])
+        if metrics is not None:
+            metrics.observe('send_bytes', sent)
+        while sent:
+            length = len(buffers[index])
+            if sent < length:
+                buffers[index] = buffers[index][sent:]
+                break
+            sent -= length
+            index += 1
+
+class SendQueueFull(Exception):
+    pass
+
+class Outbox:
+    # each frame keeps its request, so dropping one drops both
+    def __init__(self, connection: Connection, size: int = OUTBOX_SIZE, policy: str = None):
+        self.connection = connection
+        self.size = size
+        self.policy = outbox_policy if policy is None else policy
+        self.items = deque()
+        self.condition = send_ready
+        self.ready = False
+        self.sending = False
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def reserve(self, count: int = 1):
+        # before send_lock, the writer may need it to report a lost connection
+        if self.policy != 'block':
             return
-        leave()
-        with print_lock:
-            print("\n> ", end='', flush=True)
-    elif cmd == 'message':
-        if not active_connection:
-            with print_lock:
-                print("\nNot connected to any server. Use 'connect <ip> <port>' first.\n> ", end='', flush=True)
+        with self.condition:
+            while len(self.items) + count > self.size and self.connection.active and not thread_stop.is_set():
+                self.condition.wait(0.1)
+
+    def check(self, count: int = 1, strict: bool = False):
+        if (strict or self.policy == 'raise') and len(self.items) + count > self.size:
+            raise SendQueueFull(f"{len(self.items)} frames already waiting to be sent")
+
+    def put(self, frame: bytes, entry=None):
+        self.put_many([(frame, entry)])
+
+    def put_many(self, items):
+        with self.condition:
+            for item in items:
+                if len(self.items) >= self.size and self.policy == 'drop-oldest':
+                    _, dropped = self.items.popleft()
+                    self.dropped += 1
+                    if dropped is not None:
+                        self.connection.pending.drop(dropped, SendQueueFull("dropped from a full send queue"))
+                self.items.append(item)
+            if not self.ready:
+                self.ready = True
+                ready_outboxes.append(self)
+            self.condition.notify_all()
+
+    def sent(self):
+        with self.condition:
+            self.sending = False
+            self.condition.notify_all()
+
+    def clear(self):
+        with self.condition:
+            self.items.clear()
+            self.condition.notify_all()
+
+    def flush(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while (self.items or self.sending) and self.connection.active:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+def take_ready() -> list:
+    with send_ready:
+        while not ready_outboxes and not thread_stop.is_set():
+            send_ready.wait()
+        taken = []
+        while ready_outboxes:
+            outbox = ready_outboxes.popleft()
+            outbox.ready = False
+            if outbox.items:
+                taken.append((outbox, list(outbox.items)))
+                outbox.items.clear()
+                outbox.sending = True
+        send_ready.notify_all()
+    return taken
+
+def stop_writer():
+    with send_ready:
+        send_ready.notify_all()
+
+def send_loop():
+    # the only thread that writes to sockets
+    while not thread_stop.is_set():
+        for outbox, items in take_ready():
+            outbox.connection.write(items)
+            outbox.sent()
+
+writer_thread = threading.Thread(target=send_loop, daemon=True)
+
+class Event:
+    __slots__ = ()
+    opcode = None
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        fields = ', '.join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+class JoinEvent(Event):
+    __slots__ = ('username',)
+    opcode = JOIN
+
+class GroupJoinEvent(Event):
+    __slots__ = ('username', 'group_id', 'group_name')
+    opcode = GROUP_JOIN
+
+class PostEvent(Event):
+    __slots__ = ('id', 'sender', 'date', 'subject')
+    opcode = POST
+
+class GroupPostEvent(Event):
+    __slots__ = ('id', 'sender', 'date', 'subject', 'group_id', 'group_name')
+    opcode = GROUP_POST
+
+class UsersEvent(Event):
+    __slots__ = ('usernames',)
+    opcode = USERS
+
+class GroupUsersEvent(Event):
+    __slots__ = ('usernames', 'group_id', 'group_name')
+    opcode = GROUP_USERS
+
+class LeaveEvent(Event):
+    __slots__ = ('username',)
+    opcode = LEAVE
+
+class GroupLeaveEvent(Event):
+    __slots__ = ('username', 'group_id', 'group_name')
+    opcode = GROUP_LEAVE
+
+class MessageEvent(Event):
+    __slots__ = ('body',)
+    opcode = MESSAGE
+
+class GroupsEvent(Event):
+    __slots__ = ('groups',)
+    opcode = GROUPS
+
+class HelloEvent(Event):
+    __slots__ = ('features',)
+    opcode = HELLO
+
+class ErrorEvent(Event):
+    __slots__ = ('message',)
+    opcode = ERROR
+
+# field kinds used by the schemas below, see protocol.txt
+STRING = 0        # 2 byte length + utf-8 bytes
+STRING_LIST = 1   # 2 byte count + that many strings
+PAIR_LIST = 2     # 2 byte count + that many (string, string) pairs
+
+# server -> client payloads, one field kind per slot of the record type
+EVENT_SCHEMAS = {
+    JOIN: (JoinEvent, (STRING,)),
+    GROUP_JOIN: (GroupJoinEvent, (STRING, STRING, STRING)),
+    POST: (PostEvent, (STRING, STRING, STRING, STRING)),
+    GROUP_POST: (GroupPostEvent, (STRING, STRING, STRING, STRING, STRING, STRING)),
+    USERS: (UsersEvent, (STRING_LIST,)),
+    GROUP_USERS: (GroupUsersEvent, (STRING_LIST, STRING, STRING)),
+    LEAVE: (LeaveEvent, (STRING,)),
+    GROUP_LEAVE: (GroupLeaveEvent, (STRING, STRING, STRING)),
+    MESSAGE: (MessageEvent, (STRING,)),
+    GROUPS: (GroupsEvent, (PAIR_LIST,)),
+    HELLO: (HelloEvent, (STRING,)),
+    ERROR: (ErrorEvent, (STRING,)),
+}
+
+def read_string(view: memoryview, index: int):
+    end = index + 2 + (view[index] | view[index+1] << 8)
+    if end > len(view):
+        raise IndexError("string runs past end of frame")
+    return str(view[index+2:end], 'utf-8'), end
+
+def decode_frame(frame: bytes):
+    # frame is a whole message including the magic number and length
+    view = memoryview(frame)
+    if len(view) <= HEADER_SIZE:
+        return None
+    schema = EVENT_SCHEMAS.get(view[HEADER_SIZE])
+    if schema is None:
+        return None
+    record_type, fields = schema
+    values = []
+    index = HEADER_SIZE + 1
+    try:
+        for kind in fields:
+            if kind == STRING:
+                value, index = read_string(view, index)
+            else:
+                count = view[index] | view[index+1] << 8
+                index += 2
+                value = []
+                for _ in range(count):
+                    if kind == STRING_LIST:
+                        item, index = read_string(view, index)
+                    else:
+                        first, index = read_string(view, index)
+                        second, index = read_string(view, index)
+                        item = (first, second)
+                    value.append(item)
+            values.append(value)
+    except (IndexError, UnicodeDecodeError):
+        return None
+    return record_type(*values)
+
+def encode_event(event: Event) -> bytearray:
+    parts = []
+    for kind, name in zip(EVENT_SCHEMAS[event.opcode][1], event.__slots__):
+        value = getattr(event, name)
+        if kind == STRING:
+            parts.append(value.encode('utf-8'))
+            continue
+        parts.append(len(value))
+        for item in value:
+            if kind == STRING_LIST:
+                parts.append(item.encode('utf-8'))
+            else:
+                parts.append(item[0].encode('utf-8'))
+                parts.append(item[1].encode('utf-8'))
+    return pack_frame(event.opcode, parts)
+
+# client -> server payloads are all plain strings, this is how many
+REQUEST_FIELDS = {
+    JOIN: 1,
+    GROUP_JOIN: 2,
+    POST: 2,
+    GROUP_POST: 3,
+    USERS: 0,
+    GROUP_USERS: 1,
+    LEAVE: 0,
+    GROUP_LEAVE: 1,
+    MESSAGE: 1,
+    GROUP_MESSAGE: 2,
+    EXIT: 0,
+    GROUPS: 0,
+    HELLO: 1,
+}
+
+def decode_request(frame: bytes):
+    # returns (opcode, fields) or None if the frame is not a valid request
+    view = memoryview(frame)
+    if len(view) <= HEADER_SIZE:
+        return None
+    opcode = view[HEADER_SIZE]
+    count = REQUEST_FIELDS.get(opcode)
+    if count is None:
+        return None
+    fields = []
+    index = HEADER_SIZE + 1
+    try:
+        for _ in range(count):
+            field, index = read_string(view, index)
+            fields.append(field)
+    except (IndexError, UnicodeDecodeError):
+        return None
+    return opcode, tuple(fields)
+
+def render_error(event: ErrorEvent) -> str:
+    # print in red text
+    return f"\n\033[91mError from server: {event.message}\033[0m"
+
+def render_users(event: UsersEvent) -> str:
+    users = '\n'.join(event.usernames)
+    return f"\nActive users: \n{users}"
+
+def render_group_users(event: GroupUsersEvent) -> str:
+    users = '\n'.join(event.usernames)
+    return f"\nActive users of \"{event.group_name}\" (id: {event.group_id}): \n{users}"
+
+def render_post(event: PostEvent) -> str:
+    return f"\nID: {event.id}\nFrom: {event.sender}\nDate: {event.date}\nSubject: {event.subject}"
+
+def render_group_post(event: GroupPostEvent) -> str:
+    return f"\nFROM Group \"{event.group_name}\" (id: {event.group_id}):" + render_post(event)
+
+def render_join(event: JoinEvent) -> str:
+    return f"\nUser {event.username} has joined the chat."
+
+def render_group_join(event: GroupJoinEvent) -> str:
+    return f"\nUser {event.username} has joined group \"{event.group_name}\" (id: {event.group_id})"
+
+def render_leave(event: LeaveEvent) -> str:
+    return f"\nUser {event.username} has left the chat."
+
+def render_group_leave(event: GroupLeaveEvent) -> str:
+    return f"\nUser {event.username} has left group \"{event.group_name}\" (id: {event.group_id})"
+
+def render_message(event: MessageEvent) -> str:
+    return f"\n--------------------------------------\n{event.body}\n--------------------------------------"
+
+def render_hello(event: HelloEvent) -> str:
+    return f"\nServer extensions: {event.features or 'none'}"
+
+def render_groups(event: GroupsEvent) -> str:
+    groups = '\n'.join(f"\"{group_name}\" (id: {group_id})" for group_id, group_name in event.groups)
+    return f"\nActive groups: \n{groups}"
+
+RENDERERS = {
+    ErrorEvent: render_error,
+    UsersEvent: render_users,
+    GroupUsersEvent: render_group_users,
+    PostEvent: render_post,
+    GroupPostEvent: render_group_post,
+    JoinEvent: render_join,
+    GroupJoinEvent: render_group_join,
+    LeaveEvent: render_leave,
+    GroupLeaveEvent: render_group_leave,
+    MessageEvent: render_message,
+    GroupsEvent: render_groups,
+    HelloEvent: render_hello,
+}
+
+# names used for events in JSON output, same as the command that sends them
+EVENT_NAMES = {
+    JOIN: 'join',
+    GROUP_JOIN: 'groupjoin',
+    POST: 'post',
+    GROUP_POST: 'grouppost',
+    USERS: 'users',
+    GROUP_USERS: 'groupusers',
+    LEAVE: 'leave',
+    GROUP_LEAVE: 'groupleave',
+    MESSAGE: 'message',
+    GROUPS: 'groups',
+    HELLO: 'hello',
+    ERROR: 'error',
+}
+
+def event_record(event: Event) -> dict:
+    record = {'event': EVENT_NAMES[event.opcode]}
+    for name in event.__slots__:
+        record[name] = getattr(event, name)
+    return record
+
+# broadcasts that get counted instead of printed when they flood in
+SUMMARY_LABELS = {
+    POST: 'post',
+    GROUP_POST: 'post',
+    JOIN: 'join',
+    GROUP_JOIN: 'join',
+    LEAVE: 'leave',
+    GROUP_LEAVE: 'leave',
+}
+
+def render_event(event: Event) -> str:
+    return RENDERERS[type(event)](event)
+
+class Renderer:
+    # Owns the terminal and draws what piled up at most fps times a second.
+    def __init__(self, fps: int = RENDER_FPS, summary_after: int = RENDER_SUMMARY_AFTER, start_thread: bool = True):
+        self.interval = 1.0 / fps
+        self.summary_after = summary_after
+        self.start_thread = start_thread
+        self.condition = threading.Condition()
+        self.items = []
+        self.broadcasts = 0
+        self.counts = {}
+        self.input = ''
+        self.cursor = 0
+        self.prompt = True
+        self.dirty = False
+        self.stopping = False
+        self.thread = None
+
+    def show(self, text: str):
+        with self.condition:
+            self.items.append(text)
+            self.changed()
+
+    def event(self, event: Event, group_id: str = None, source: str = None):
+        label = SUMMARY_LABELS.get(event.opcode)
+        with self.condition:
+            if label is not None and self.summary_after is not None and self.prompt:
+                if self.broadcasts >= self.summary_after:
+                    group = event.group_id if group_id is None else group_id
+                    key = (label, group if source is None else f"{source}/{group}")
+                    self.counts[key] = self.counts.get(key, 0) + 1
+                    self.changed()
+                    return
+                self.broadcasts += 1
+            self.items.append(event if source is None else (source, event))
+            self.changed()
+
+    def edit(self, command: str, cursor: int):
+        with self.condition:
+            self.input = command
+            self.cursor = cursor
+            self.changed()
+
+    def submit(self, command: str):
+        with self.condition:
+            self.items.append("> " + command)
+            self.input = ''
+            self.cursor = 0
+            self.changed()
+
+    def changed(self):
+        self.dirty = True
+        if not self.start_thread:
+            # nobody draws, only keep the output from piling up
+            if len(self.items) > 4096:
+                self.items.clear()
             return
-        if len(tokens) != 2:
-            with print_lock:
-                print("\nUsage: message <id>\n> ", end='', flush=True)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.condition.notify()
+
+    def stop(self, timeout: float = 1.0):
+        with self.condition:
+            self.stopping = True
+            self.dirty = True
+            self.condition.notify()
+            thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def run(self):
+        last = 0.0
+        while True:
+            with self.condition:
+                while not self.dirty:
+                    self.condition.wait()
+                stopping = self.stopping
+            delay = last + self.interval - time.monotonic()
+            if delay > 0 and not stopping:
+                time.sleep(delay)
+            with self.condition:
+                stopping = self.stopping
+                text = self.frame(stopping)
+            try:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            except (OSError, ValueError):
+                return
+            if metrics is not None:
+                metrics.observe('render_bytes', len(text))
+            last = time.monotonic()
+            if stopping:
+                return
+
+    def frame(self, final: bool) -> str:
+        items, self.items = self.items, []
+        counts, self.counts = self.counts, {}
+        self.broadcasts = 0
+        self.dirty = False
+        if not self.prompt:
+            return ''.join(item + "\n" for item in items)
+        parts = ["\r\033[K"]
+        for item in items:
+            if type(item) is str:
+                text = item
+            elif type(item) is tuple:
+                text = f"[{item[0]}] " + render_event(item[1]).lstrip("\n")
+            else:
+                text = render_event(item)
+            if text.startswith("\n"):
+                text = text[1:]
+            parts.append(text + "\n")
+        for (label, group_id), count in counts.items():
+            parts.append(f"+{count} {label}{'' if count == 1 else 's'} in {group_id}\n")
+        if not final:
+            parts.append("> " + self.input)
+            if self.cursor < len(self.input):
+                parts.append(f"\033[{len(self.input) - self.cursor}D")
+        return ''.join(parts)
+
+# made by main(), tools that skip main() set their own
+renderer = None
+
+def emit(record: dict):
+    import json
+    renderer.show(json.dumps(record, ensure_ascii=False))
+
+def notify(text: str, kind: str, **fields):
+    if json_output:
+        emit({'type': kind, **fields})
+        return
+    renderer.show(text)
+
+def show(text: str):
+    # to the terminal, or into the result record of a script command
+    output = getattr(local_state, 'output', None)
+    if output is not None:
+        output.append(text.strip('\n'))
+    elif json_output:
+        emit({'type': 'output', 'text': text.strip('\n')})
+    else:
+        renderer.show(text)
+
+class ServerError(Exception):
+    pass
+
+# request opcode -> opcode of the frame that answers it
+REPLIES = {
+    USERS: USERS,
+    GROUP_USERS: GROUP_USERS,
+    GROUPS: GROUPS,
+    MESSAGE: MESSAGE,
+    GROUP_MESSAGE: MESSAGE,
+    HELLO: HELLO,
+}
+# only answered on failure, so a GROUPS request sent behind them confirms them
+BARRIERED = {JOIN, GROUP_JOIN, LEAVE, GROUP_LEAVE, HELLO}
+
+class PendingRequest:
+    __slots__ = ('opcode', 'fields', 'future', 'internal', 'sender', 'previous', 'sent_at', 'deadline', 'latency')
+
+    def __init__(self, opcode: int, fields: tuple, future, internal: bool, timeout: float = None):
+        self.opcode = opcode
+        self.fields = fields
+        self.future = future
+        self.internal = internal
+        self.sender = None
+        self.previous = None
+        self.sent_at = time.perf_counter()
+        self.deadline = None if timeout is None else self.sent_at + timeout
+        self.latency = None
+
+class PendingRequests:
+    # The server answers a connection's frames in order.
+    def __init__(self, timeout: float = REQUEST_TIMEOUT):
+        # futures complete outside the lock, their callbacks may send requests
+        self.lock = threading.Lock()
+        self.queue = deque()
+        self.usernames = {}
+        self.on_complete = None
+        self.interactive = 0
+        self.timeout = timeout
+
+    def track(self, opcode: int, fields: tuple, future, internal: bool = False) -> PendingRequest:
+        entry = PendingRequest(opcode, fields, future, internal, self.timeout)
+        with self.lock:
+            if not internal:
+                self.interactive += 1
+            if opcode == JOIN:
+                entry.previous = self.usernames.get(None)
+                self.usernames[None] = fields[0]
+            elif opcode == GROUP_JOIN:
+                entry.previous = self.usernames.get(fields[0])
+                self.usernames[fields[0]] = fields[1]
+            elif opcode == LEAVE:
+                # popped when sent, so a later join isn't undone by its reply
+                entry.previous = self.usernames.pop(None, None)
+            elif opcode == GROUP_LEAVE:
+                entry.previous = self.usernames.pop(fields[0], None)
+            elif opcode == POST:
+                entry.sender = self.usernames.get(None)
+            elif opcode == GROUP_POST:
+                entry.sender = self.usernames.get(fields[0])
+            self.queue.append(entry)
+        return entry
+
+    def resolve(self, event: Event):
+        # returns the request this event answers, or None for broadcasts
+        finished = []
+        with self.lock:
+            answered = self.match(event, finished)
+        for entry, result, error in finished:
+            self.complete(entry, result, error)
+        return answered
+
+    def match(self, event: Event, finished: list):
+        queue = self.queue
+        if not queue:
+            return None
+        opcode = event.opcode
+        if opcode == ERROR:
+            entry = queue.popleft()
+            finished.append(self.settle(entry, None, ServerError(event.message)))
+            return entry
+        if opcode == POST or opcode == GROUP_POST:
+            entry = queue[0]
+            if entry.opcode == opcode and entry.sender == event.sender and (opcode == POST or entry.fields[0] == event.group_id):
+                queue.popleft()
+                finished.append(self.settle(entry, event))
+            return None
+        if opcode not in REPLIES:
+            return None
+        while queue:
+            entry = queue.popleft()
+            expected = REPLIES.get(entry.opcode)
+            if expected == opcode:
+                finished.append(self.settle(entry, event))
+                return entry
+            if expected is not None:
+                finished.append(self.settle(entry, None, ServerError(f"unexpected reply opcode {opcode:#04x}")))
+            else:
+                # nothing came back for it before this reply, so it succeeded
+                finished.append(self.settle(entry, None))
+        return None
+
+    def settle(self, entry: PendingRequest, result, error: Exception = None) -> tuple:
+        # called holding the lock
+        entry.latency = time.perf_counter() - entry.sent_at
+        if not entry.internal:
+            self.interactive -= 1
+        if metrics is not None:
+            metrics.observe('request_seconds', entry.latency, entry.opcode)
+            if error is not None:
+                metrics.count('request_errors', entry.opcode)
+        if error is not None and entry.opcode in (JOIN, GROUP_JOIN, LEAVE, GROUP_LEAVE):
+            key = entry.fields[0] if entry.opcode in (GROUP_JOIN, GROUP_LEAVE) else None
+            if entry.previous is None:
+                self.usernames.pop(key, None)
+            else:
+                self.usernames[key] = entry.previous
+        return entry, result, error
+
+    def complete(self, entry: PendingRequest, result, error: Exception = None):
+        future = entry.future
+        if not future.done():
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+        if self.on_complete is not None:
+            self.on_complete(entry)
+
+    def drop(self, entry: PendingRequest, error: Exception):
+        # the frame for this request was never sent
+        with self.lock:
+            try:
+                self.queue.remove(entry)
+            except ValueError:
+                return
+            self.settle(entry, None, error)
+        self.complete(entry, None, error)
+
+    def joining_group(self):
+        # GROUP_JOIN is answered with the group's last posts as plain POST frames
+        with self.lock:
+            if self.queue and self.queue[0].opcode == GROUP_JOIN:
+                return self.queue[0].fields[0]
+        return None
+
+    def memberships(self) -> list:
+        with self.lock:
+            return list(self.usernames.items())
+
+    def fail_all(self, error: Exception):
+        with self.lock:
+            finished = [self.settle(entry, None, error) for entry in self.queue]
+            self.queue.clear()
+        for entry, result, error in finished:
+            self.complete(entry, result, error)
+
+    def expire(self, now: float):
+        # entries stay queued so a late reply still lines up with its request
+        expired = []
+        with self.lock:
+            for entry in self.queue:
+                if entry.deadline is None or entry.deadline > now:
+                    break
+                if not entry.future.done():
+                    expired.append(entry)
+        for entry in expired:
+            if metrics is not None:
+                metrics.count('request_timeouts', entry.opcode)
+            entry.future.set_exception(TimeoutError(f"no reply within {self.timeout:g}s"))
+
+class MessageCache:
+    # Bodies never change, so they are kept until the byte budget runs out.
+    def __init__(self, budget: int = MESSAGE_CACHE_BYTES):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple):
+        body = self.entries.get(key)
+        if body is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return body[0]
+
+    def put(self, key: tuple, body: str):
+        size = len(body.encode('utf-8'))
+        if size > self.budget:
             return
-        message_command(tokens[1])
-    elif cmd == 'groups':
-        if not active_connection:
-            with print_lock:
-                print("\nNot connected to any server. Use 'connect <ip> <port>' first.\n> ", end='', flush=True)
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        self.entries[key] = (body, size)
+        self.size += size
+        while self.size > self.budget:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= evicted
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+class HeaderIndex:
+    # Post headers stored column-wise; the sorted arrays catch up on the next query.
+    def __init__(self):
+        self.group_ids = []
+        self.ids = []
+        self.senders = []
+        self.dates = []
+        self.subjects = []
+        self.by_sender = {}
+        # group id -> {message id: row}, in arrival order
+        self.by_group = {}
+        self.by_subject = array('q')
+        self.by_date = array('q')
+        self.subject_text = ''
+        self.subject_offsets = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, group_id: str, id: str, sender: str, date: str, subject: str) -> int:
+        group = self.by_group.get(group_id)
+        if group is None:
+            group = self.by_group[sys.intern(group_id)] = {}
+        row = group.get(id)
+        if row is not None:
+            return row
+        row = len(self.ids)
+        group_id = sys.intern(group_id)
+        sender = sys.intern(sender)
+        date = sys.intern(date)
+        self.group_ids.append(group_id)
+        self.ids.append(id)
+        self.senders.append(sender)
+        self.dates.append(date)
+        self.subjects.append(subject)
+        self.by_sender.setdefault(sender, []).append(row)
+        group[id] = row
+        return row
+
+    def add_event(self, event: Event, group_id: str = PUBLIC_GROUP) -> int:
+        if event.opcode == GROUP_POST:
+            group_id = event.group_id
+        return self.add(group_id, event.id, event.sender, event.date, event.subject)
+
+    def header(self, row: int) -> tuple:
+        return (self.group_ids[row], self.ids[row], self.senders[row], self.dates[row], self.subjects[row])
+
+    def fold(self):
+        count = len(self.subject_offsets)
+        if count == len(self.subjects):
             return
-        groups()
-    elif cmd == 'groupjoin':
-        if not active_connection:
-            with print_lock:
-                print("\nNot connected to any server. Use 'connect <ip> <port>' first.\n> ", end='', flush=True)
+        added = [subject.lower().replace('\n', ' ') for subject in self.subjects[count:]]
+        offset = len(self.subject_text)
+        for subject in added:
+            self.subject_offsets.append(offset)
+            offset += len(subject) + 1
+        self.subject_text += '\n'.join(added) + '\n'
+
+    def folded(self, row: int) -> str:
+        offsets = self.subject_offsets
+        end = offsets[row + 1] if row + 1 < len(offsets) else len(self.subject_text)
+        return self.subject_text[offsets[row]:end - 1]
+
+    def sorted_rows(self, rows: array, key) -> array:
+        # ties stay in arrival order
+        count = len(self.ids)
+        added = count - len(rows)
+        if added > len(rows):
+            rows = array('q', sorted(range(count), key=key))
+        else:
+            for row in range(count - added, count):
+                insort(rows, row, key=key)
+        return rows
+
+    def subject_rows(self, text: str) -> list:
+        self.fold()
+        haystack = self.subject_text
+        offsets = self.subject_offsets
+        rows = []
+        index = haystack.find(text)
+        while index != -1:
+            row = bisect_right(offsets, index) - 1
+            rows.append(row)
+            if row + 1 == len(offsets):
+                break
+            index = haystack.find(text, offsets[row+1])
+        return rows
+
+    def search(self, sender: str = None, group_id: str = None, subject: str = None, prefix: str = None, since: str = None, until: str = None) -> list:
+        # enumerate the smallest candidate set, check the other criteria per row
+        senders, group_ids, dates, folded = self.senders, self.group_ids, self.dates, self.folded
+        sources = []
+        checks = []
+        if sender is not None:
+            by_sender = self.by_sender.get(sender, [])
+            sources.append((len(by_sender), lambda: by_sender, lambda row: senders[row] == sender))
+        if group_id is not None:
+            by_group = self.by_group.get(group_id, {})
+            sources.append((len(by_group), lambda: list(by_group.values()), lambda row: group_ids[row] == group_id))
+        if prefix is not None or subject is not None:
+            self.fold()
+        if prefix is not None:
+            prefix = prefix.lower()
+            by_subject = self.by_subject = self.sorted_rows(self.by_subject, folded)
+            prefix_low = bisect_left(by_subject, prefix, key=folded)
+            prefix_high = bisect_left(by_subject, prefix + '\U0010ffff', key=folded)
+            sources.append((prefix_high - prefix_low, lambda: sorted(by_subject[prefix_low:prefix_high]),
+                            lambda row: folded(row).startswith(prefix)))
+        if since is not None or until is not None:
+            by_date = self.by_date = self.sorted_rows(self.by_date, dates.__getitem__)
+            date_low = 0 if since is None else bisect_left(by_date, since, key=dates.__getitem__)
+            date_high = len(by_date) if until is None else bisect_right(by_date, until, key=dates.__getitem__)
+            sources.append((date_high - date_low, lambda: sorted(by_date[date_low:date_high]),
+                            lambda row: (since is None or dates[row] >= since) and (until is None or dates[row] <= until)))
+        if subject is not None:
+            text = subject.lower()
+            checks.append(lambda row: text in folded(row))
+            if not sources:
+                return self.subject_rows(text)
+        if not sources:
+            return list(range(len(self.ids)))
+        chosen = min(sources, key=lambda source: source[0])
+        checks.extend(check for _, _, check in sources if check is not chosen[2])
+        rows = chosen[1]()
+        if not checks:
+            return list(rows)
+        return [row for row in rows if all(check(row) for check in checks)]
+
+class Directory:
+    # Group names, and member lists kept current from join and leave broadcasts.
+    def __init__(self, tracking: bool = True):
+        self.tracking = tracking
+        self.lock = threading.Lock()
+        self.names = {}
+        self.members = {}
+        self.replies = {}
+
+    def apply(self, event: Event, memberships: dict):
+        opcode = event.opcode
+        with self.lock:
+            if opcode == GROUPS:
+                for group_id, group_name in event.groups:
+                    self.name(group_id, group_name)
+                return
+            if opcode in (GROUP_JOIN, GROUP_LEAVE, GROUP_POST, GROUP_USERS):
+                group_id = self.name(event.group_id, event.group_name)
+            elif opcode in (JOIN, LEAVE, USERS):
+                group_id = PUBLIC_GROUP
+            else:
+                return
+            if not self.tracking:
+                return
+            if opcode == USERS or opcode == GROUP_USERS:
+                if (None if opcode == USERS else group_id) in memberships:
+                    self.members[group_id] = dict.fromkeys(map(sys.intern, event.usernames))
+                    self.replies[group_id] = event
+                return
+            members = self.members.get(group_id)
+            if members is None or opcode == GROUP_POST:
+                return
+            if opcode == JOIN or opcode == GROUP_JOIN:
+                members[sys.intern(event.username)] = None
+            else:
+                members.pop(event.username, None)
+            self.replies.pop(group_id, None)
+
+    def name(self, group_id: str, group_name: str) -> str:
+        if self.names.get(group_id) != group_name:
+            group_id = sys.intern(group_id)
+            self.names[group_id] = sys.intern(group_name)
+        return group_id
+
+    def users(self, group_id: str):
+        # None without a member list for the group
+        with self.lock:
+            reply = self.replies.get(group_id)
+            if reply is None and group_id in self.members:
+                usernames = list(self.members[group_id])
+                if group_id == PUBLIC_GROUP:
+                    reply = UsersEvent(usernames)
+                else:
+                    reply = GroupUsersEvent(usernames, group_id, self.names.get(group_id, group_id))
+                self.replies[group_id] = reply
+            return reply
+
+    def forget(self, group_id: str = None):
+        with self.lock:
+            if group_id is None:
+                self.members.clear()
+                self.replies.clear()
+            else:
+                self.members.pop(group_id, None)
+                self.replies.pop(group_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.names.clear()
+            self.members.clear()
+            self.replies.clear()
+
+    def finished(self, entry: PendingRequest):
+        # PendingRequests.on_complete hook
+        if entry.opcode == LEAVE or entry.opcode == GROUP_LEAVE:
+            if not entry.future.cancelled() and entry.future.exception() is None:
+                self.forget(PUBLIC_GROUP if entry.opcode == LEAVE else entry.fields[0])
+
+def message_key(entry: PendingRequest) -> tuple:
+    if entry.opcode == MESSAGE:
+        return (PUBLIC_GROUP, entry.fields[0])
+    return (entry.fields[0], entry.fields[1])
+
+ARCHIVE_ENTRY = struct.Struct('<QQ')
+
+def archive_key(kind: str, group_id: str, msg_id: str) -> int:
+    import hashlib
+    digest = hashlib.blake2b(f"{kind}\0{group_id}\0{msg_id}".encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+class Archive:
+    # Append-only log of wire-format frames, with an (offset, key hash) index.
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.lock = threading.Lock()
+        self.map = None
+        self.skipped = 0
+        self.open()
+
+    def open(self):
+        self.log = open(self.path, 'ab+')
+        self.index = open(self.index_path, 'ab+')
+        self.size = self.log.seek(0, os.SEEK_END)
+        self.offsets = {}
+        self.index.seek(0)
+        entries = self.index.read()
+        entries = entries[:len(entries) - len(entries) % ARCHIVE_ENTRY.size]
+        kept = 0
+        previous = -1
+        for offset, key in ARCHIVE_ENTRY.iter_unpack(entries):
+            if offset <= previous or offset + HEADER_SIZE > self.size:
+                break
+            self.offsets.setdefault(key, offset)
+            previous = offset
+            kept += 1
+        # only the last record is checked, the log is never parsed on open
+        end = 0
+        while kept:
+            offset, key = ARCHIVE_ENTRY.unpack_from(entries, (kept - 1) * ARCHIVE_ENTRY.size)
+            record = self.read(offset)
+            if record is not None:
+                end = offset + len(record)
+                break
+            if self.offsets.get(key) == offset:
+                del self.offsets[key]
+            kept -= 1
+        if kept * ARCHIVE_ENTRY.size != self.index.tell():
+            self.index.truncate(kept * ARCHIVE_ENTRY.size)
+        # a crash between the two writes leaves records the index is missing
+        self.recover(end)
+
+    def recover(self, offset: int):
+        while offset < self.size:
+            record = self.read(offset)
+            key = None if record is None else record_key(record)
+            if key is None:
+                # torn write at the end of the log
+                self.log.truncate(offset)
+                self.size = offset
+                break
+            self.index.write(ARCHIVE_ENTRY.pack(offset, key))
+            self.offsets.setdefault(key, offset)
+            offset += len(record)
+        self.index.flush()
+
+    def read(self, offset: int):
+        # one whole record, None if there isn't a valid one at offset
+        if self.map is None or offset + HEADER_SIZE > len(self.map):
+            self.remap()
+            if self.map is None or offset + HEADER_SIZE > len(self.map):
+                return None
+        if self.map[offset:offset+4] != MAGIC:
+            return None
+        end = offset + HEADER_SIZE + (self.map[offset+4] | self.map[offset+5] << 8)
+        if end > len(self.map):
+            self.remap()
+            if end > len(self.map):
+                return None
+        return self.map[offset:end]
+
+    def remap(self):
+        self.log.flush()
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.size:
+            import mmap
+            self.map = mmap.mmap(self.log.fileno(), self.size, access=mmap.ACCESS_READ)
+
+    def append(self, key: int, frame: bytes):
+        offset = self.size
+        self.log.write(frame)
+        self.index.write(ARCHIVE_ENTRY.pack(offset, key))
+        self.size += len(frame)
+        self.offsets.setdefault(key, offset)
+
+    def add_header(self, event: PostEvent, group_id: str, group_name: str):
+        key = archive_key('H', group_id, event.id)
+        with self.lock:
+            if key in self.offsets:
+                return
+            self.append(key, encode_event(GroupPostEvent(event.id, event.sender, event.date, event.subject, group_id, group_name)))
+
+    def add_body(self, group_id: str, msg_id: str, body: str):
+        key = archive_key('B', group_id, msg_id)
+        with self.lock:
+            if key in self.offsets:
+                return
+            try:
+                frame = encode_frame(GROUP_MESSAGE, group_id, msg_id, body)
+            except ValueError:
+                # the ids and body together don't fit in one frame
+                self.skipped += 1
+                return
+            self.append(key, frame)
+
+    def body(self, group_id: str, msg_id: str):
+        with self.lock:
+            offset = self.offsets.get(archive_key('B', group_id, msg_id))
+            record = None if offset is None else self.read(offset)
+        if record is None:
+            return None
+        fields = read_body_record(record)
+        if fields is None or fields[0] != group_id or fields[1] != msg_id:
+            return None
+        return fields[2]
+
+    def has_body(self, group_id: str, msg_id: str) -> bool:
+        return archive_key('B', group_id, msg_id) in self.offsets
+
+    def header(self, group_id: str, msg_id: str):
+        with self.lock:
+            offset = self.offsets.get(archive_key('H', group_id, msg_id))
+            record = None if offset is None else self.read(offset)
+        if record is None:
+            return None
+        event = decode_frame(record)
+        if event is None or event.group_id != group_id or event.id != msg_id:
+            return None
+        return event
+
+    def records(self):
+        # (header, None) or (None, (group_id, id, body)), oldest first
+        offset = 0
+        while True:
+            with self.lock:
+                record = self.read(offset) if offset < self.size else None
+            if record is None:
+                return
+            offset += len(record)
+            if record[HEADER_SIZE] == GROUP_POST:
+                yield decode_frame(record), None
+            else:
+                yield None, read_body_record(record)
+
+    def compact(self, drop_groups: tuple = ()) -> tuple:
+        # returns the sizes before and after
+        drop_groups = set(drop_groups)
+        with self.lock:
+            before = self.size
+            temporary = self.path + '.compact'
+            seen = set()
+            with open(temporary, 'wb') as log, open(temporary + '.idx', 'wb') as index:
+                offset = 0
+                written = 0
+                while offset < self.size:
+                    record = self.read(offset)
+                    if record is None:
+                        break
+                    offset += len(record)
+                    key = record_key(record)
+                    if key is None or key in seen or record_group(record) in drop_groups:
+                        continue
+                    seen.add(key)
+                    log.write(record)
+                    index.write(ARCHIVE_ENTRY.pack(written, key))
+                    written += len(record)
+            self.close_files()
+            os.replace(temporary, self.path)
+            os.replace(temporary + '.idx', self.index_path)
+            self.open()
+            return before, self.size
+
+    def flush(self):
+        with self.lock:
+            self.log.flush()
+            self.index.flush()
+
+    def close_files(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.log.close()
+        self.index.close()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.close_files()
+
+def read_body_record(record) -> tuple:
+    try:
+        group_id, index = read_string(record, HEADER_SIZE + 1)
+        msg_id, index = read_string(record, index)
+        body, _ = read_string(record, index)
+    except (IndexError, UnicodeDecodeError):
+        return None
+    return group_id, msg_id, body
+
+def record_group(record) -> str:
+    if record[HEADER_SIZE] == GROUP_POST:
+        return decode_frame(record).group_id
+    return read_body_record(record)[0]
+
+def record_key(record):
+    if len(record) <= HEADER_SIZE:
+        return None
+    if record[HEADER_SIZE] == GROUP_POST:
+        event = decode_frame(record)
+        return None if event is None else archive_key('H', event.group_id, event.id)
+    if record[HEADER_SIZE] == GROUP_MESSAGE:
+        fields = read_body_record(record)
+        return None if fields is None else archive_key('B', fields[0], fields[1])
+    return None
+
+class Prefetcher:
+    # Fetches new posts' bodies in the background, never ahead of our own commands.
+    def __init__(self, connection: Connection, concurrency: int = PREFETCH_CONCURRENCY, size: int = PREFETCH_QUEUE_SIZE):
+        self.connection = connection
+        self.concurrency = concurrency
+        self.size = size
+        self.groups = set()
+        self.lock = threading.Lock()
+        self.queue = deque()
+        self.queued = set()
+        self.in_flight = 0
+        self.fetched = 0
+        self.failed = 0
+
+    def enabled(self, group_id: str) -> bool:
+        return group_id in self.groups or '*' in self.groups
+
+    def announce(self, group_id: str, msg_id: str):
+        key = (group_id, msg_id)
+        if self.connection.has_body(group_id, msg_id):
             return
-        if len(tokens) != 3:
-            with print_lock:
-                print("\nUsage: groupjoin <group_id> <username>\n> ", end='', flush=True)
+        with self.lock:
+            if key in self.queued:
+                return
+            if len(self.queue) == self.size:
+                self.queued.discard(self.queue.popleft())
+            self.queue.append(key)
+            self.queued.add(key)
+
+    def pump(self):
+        connection = self.connection
+        while True:
+            with self.lock:
+                if not self.queue or self.in_flight >= self.concurrency or connection.pending.interactive or not connection.active:
+                    return
+                key = self.queue.pop()
+                if connection.has_body(*key):
+                    self.queued.discard(key)
+                    continue
+                self.in_flight += 1
+            group_id, msg_id = key
+            # never waits for room in the outbox, this is the reader thread
+            try:
+                if group_id == PUBLIC_GROUP:
+                    future = connection.request(MESSAGE, msg_id, internal=True, block=False)
+                else:
+                    future = connection.request(GROUP_MESSAGE, group_id, msg_id, internal=True, block=False)
+            except SendQueueFull:
+                with self.lock:
+                    self.in_flight -= 1
+                    self.queue.append(key)
+                return
+            except ValueError:
+                with self.lock:
+                    self.in_flight -= 1
+                    self.queued.discard(key)
+                    self.failed += 1
+                return
+            future.add_done_callback(lambda future, key=key: self.finished(key, future))
+
+    def finished(self, key: tuple, future: Future):
+        with self.lock:
+            self.in_flight -= 1
+            self.queued.discard(key)
+            if future.exception() is None:
+                self.fetched += 1
+            else:
+                self.failed += 1
+
+    def forget(self, group_id: str = None):
+        with self.lock:
+            kept = deque()
+            for key in self.queue:
+                if group_id is None or key[0] == group_id:
+                    self.queued.discard(key)
+                else:
+                    kept.append(key)
+            self.queue = kept
+
+class SubscriberOverflow(Exception):
+    pass
+
+class Subscription:
+    # Bounded queue of events for one consumer, iterated sync or async.
+    def __init__(self, hub, keys: tuple, size: int, policy: str):
+        if policy not in ('drop-oldest', 'drop-newest', 'close'):
+            raise ValueError(f"Unknown overflow policy {policy!r}.")
+        self.hub = hub
+        self.keys = keys
+        self.size = size
+        self.policy = policy
+        self.queue = deque()
+        self.ready = threading.Condition()
+        # (loop, future) of a coroutine waiting in __anext__
+        self.waiter = None
+        self.closed = False
+        self.overflowed = False
+        self.dropped = 0
+
+    def put(self, event: Event):
+        with self.ready:
+            if self.closed:
+                return
+            if len(self.queue) >= self.size:
+                self.dropped += 1
+                if metrics is not None:
+                    metrics.count('subscriber_drops', event.opcode)
+                if self.policy == 'drop-newest':
+                    return
+                if self.policy == 'close':
+                    self.overflowed = True
+                    self.closed = True
+                    self.hub.remove(self)
+                    self.wake()
+                    return
+                self.queue.popleft()
+            self.queue.append(event)
+            self.wake()
+
+    def wake(self):
+        # with self.ready held
+        self.ready.notify_all()
+        waiter = self.waiter
+        if waiter is not None:
+            self.waiter = None
+            waiter[0].call_soon_threadsafe(release, waiter[1])
+
+    def get(self, timeout: float = None):
+        # the next event, None after timeout seconds without one
+        with self.ready:
+            if not self.ready.wait_for(lambda: self.queue or self.closed, timeout):
+                return None
+            if self.queue:
+                return self.queue.popleft()
+        raise self.ended()
+
+    def ended(self) -> Exception:
+        if self.overflowed:
+            return SubscriberOverflow(f"fell {self.size} events behind")
+        return StopIteration()
+
+    def close(self):
+        with self.ready:
+            if self.closed:
+                return
+            self.closed = True
+            self.wake()
+        self.hub.remove(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.get()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        import asyncio
+        while True:
+            with self.ready:
+                if self.queue:
+                    return self.queue.popleft()
+                if self.closed:
+                    error = self.ended()
+                    raise StopAsyncIteration if isinstance(error, StopIteration) else error
+                loop = asyncio.get_running_loop()
+                future = loop.create_future()
+                self.waiter = (loop, future)
+            await future
+
+def release(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+class Subscriptions:
+    # One dict lookup per key shape; routes are swapped in whole, read without a lock.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.members = []
+        self.table = ({}, ())
+
+    def subscribe(self, opcodes=None, group_id: str = None, sender: str = None, size: int = SUBSCRIBER_QUEUE_SIZE, policy: str = SUBSCRIBER_POLICY) -> Subscription:
+        if isinstance(opcodes, int):
+            opcodes = (opcodes,)
+        keys = tuple((opcode, group_id, sender) for opcode in (opcodes or (None,)))
+        subscription = Subscription(self, keys, size, policy)
+        with self.lock:
+            self.members.append(subscription)
+            self.rebuild()
+        return subscription
+
+    def remove(self, subscription: Subscription):
+        with self.lock:
+            if subscription in self.members:
+                self.members.remove(subscription)
+                self.rebuild()
+
+    def rebuild(self):
+        # with self.lock held
+        routes = {}
+        for subscription in self.members:
+            for key in subscription.keys:
+                routes.setdefault(key, []).append(subscription)
+        shapes = {tuple(part is not None for part in key) for key in routes}
+        self.table = ({key: tuple(members) for key, members in routes.items()}, tuple(shapes))
+
+    def publish(self, event: Event, group_id: str = None):
+        routes, shapes = self.table
+        if not routes:
             return
-        group_id = tokens[1]
-        username = tokens[2]
-        group_join(group_id, username)
-        with print_lock:
-            print("\n> ", end='', flush=True)
-    elif cmd == 'grouppost':
-        if not active_connection:
-            with print_lock:
-                print("\nNot connected to any server. Use 'connect <ip> <port>' first.\n> ", end='', flush=True)
+        group_id = getattr(event, 'group_id', group_id)
+        sender = event_sender(event)
+        opcode = event.opcode
+        for by_opcode, by_group, by_sender in shapes:
+            members = routes.get((opcode if by_opcode else None, group_id if by_group else None, sender if by_sender else None))
+            if members is not None:
+                for subscription in members:
+                    subscription.put(event)
+
+    def close(self):
+        for subscription in tuple(self.members):
+            subscription.close()
+
+    def __len__(self):
+        return len(self.members)
+
+def event_sender(event: Event):
+    # who caused the event: the poster, or the member who joined or left
+    sender = getattr(event, 'sender', None)
+    return getattr(event, 'username', None) if sender is None else sender
+
+BYTE_BUCKETS = tuple(2 ** i for i in range(4, 21))
+COUNT_BUCKETS = tuple(2 ** i for i in range(13))
+SECOND_BUCKETS = tuple(1e-6 * 2 ** i for i in range(25))
+METRIC_BUCKETS = {
+    'recv_bytes': BYTE_BUCKETS,
+    'send_bytes': BYTE_BUCKETS,
+    'render_bytes': BYTE_BUCKETS,
+    'outbox_depth': COUNT_BUCKETS,
+}
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float):
+        # upper bound of the bucket the q-th value falls in
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.bounds[index] if index < len(self.bounds) else float('inf')
+        return 0
+
+def percentiles(values: list) -> dict:
+    # exact percentiles in milliseconds, for bench.py and soak.py
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+    count = len(values)
+    def at(fraction):
+        return values[min(count - 1, int(fraction * count))] * 1000
+    return {
+        'count': count,
+        'mean_ms': sum(values) / count * 1000,
+        'p50_ms': at(0.50),
+        'p95_ms': at(0.95),
+        'p99_ms': at(0.99),
+        'max_ms': values[-1] * 1000,
+    }
+
+class Metrics:
+    # Counters and histograms for the hot paths, made by enable_metrics().
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def count(self, name: str, label=None, value: int = 1):
+        key = (name, label)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value, label=None):
+        key = (name, label)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(METRIC_BUCKETS.get(name, SECOND_BUCKETS))
+            histogram.observe(value)
+
+    def received(self, opcode: int, seconds: float):
+        key = ('handle_seconds', opcode)
+        with self.lock:
+            self.counters[('frames_in', opcode)] = self.counters.get(('frames_in', opcode), 0) + 1
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(SECOND_BUCKETS)
+            histogram.observe(seconds)
+
+    def gauge(self, name: str, read):
+        self.gauges[name] = read
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            counters = list(self.counters.items())
+            histograms = [(key, histogram.count, histogram.sum, histogram.quantile(0.5), histogram.quantile(0.99), list(histogram.counts))
+                          for key, histogram in self.histograms.items()]
+        snapshot = {'uptime': round(time.time() - self.started, 3), 'counters': {}, 'histograms': {}, 'gauges': {}}
+        for (name, label), value in sorted(counters, key=metric_order):
+            snapshot['counters'].setdefault(name, {})[label_name(label)] = value
+        for (name, label), count, total, p50, p99, buckets in sorted(histograms, key=metric_order):
+            snapshot['histograms'].setdefault(name, {})[label_name(label)] = {
+                'count': count, 'sum': total, 'p50': p50, 'p99': p99, 'buckets': buckets,
+            }
+        for name, read in self.gauges.items():
+            snapshot['gauges'][name] = read()
+        return snapshot
+
+    def prometheus(self) -> str:
+        snapshot = self.snapshot()
+        lines = []
+        for name, values in snapshot['counters'].items():
+            lines.append(f"# TYPE bulletin_{name}_total counter")
+            for label, value in values.items():
+                lines.append(f"bulletin_{name}_total{prometheus_labels(label)} {value}")
+        for name, values in snapshot['histograms'].items():
+            bounds = METRIC_BUCKETS.get(name, SECOND_BUCKETS)
+            lines.append(f"# TYPE bulletin_{name} histogram")
+            for label, histogram in values.items():
+                cumulative = 0
+                for bound, count in zip(bounds + (float('inf'),), histogram['buckets']):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f"bulletin_{name}_bucket{prometheus_labels(label, le)} {cumulative}")
+                lines.append(f"bulletin_{name}_sum{prometheus_labels(label)} {histogram['sum']}")
+                lines.append(f"bulletin_{name}_count{prometheus_labels(label)} {histogram['count']}")
+        for name, value in snapshot['gauges'].items():
+            lines.append(f"# TYPE bulletin_{name} gauge")
+            lines.append(f"bulletin_{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+def metric_order(item: tuple):
+    (name, label) = item[0]
+    return name, label_name(label)
+
+def label_name(label) -> str:
+    if label is None:
+        return ''
+    if type(label) is int:
+        return OPCODE_NAMES.get(label, f"{label:#04x}")
+    return str(label)
+
+def prometheus_labels(label: str, le: str = None) -> str:
+    pairs = []
+    if label:
+        pairs.append(f'opcode="{label}"')
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def render_stats(snapshot: dict) -> str:
+    lines = [f"\nMetrics for the last {snapshot['uptime']:.1f}s"]
+    for name, values in snapshot['counters'].items():
+        lines.append(f"{name}: " + ', '.join(f"{label} {value}" if label else str(value) for label, value in values.items()))
+    for name, values in snapshot['histograms'].items():
+        scale, unit = (1e6, 'us') if name.endswith('_seconds') else (1, '')
+        for label, histogram in values.items():
+            mean = histogram['sum'] / histogram['count'] * scale
+            lines.append(f"{name}{' ' + label if label else ''}: n={histogram['count']} mean={mean:.1f}{unit} "
+                         f"p50<={histogram['p50'] * scale:g}{unit} p99<={histogram['p99'] * scale:g}{unit}")
+    lines.append(', '.join(f"{name} {value}" for name, value in snapshot['gauges'].items()))
+    return '\n'.join(lines)
+
+def enable_metrics() -> Metrics:
+    global metrics
+    if metrics is None:
+        collector = Metrics()
+        collector.gauge('connections', lambda: sum(connection.active for connection in tuple(connections.values())))
+        collector.gauge('outbox_frames', lambda: total(lambda connection: len(connection.outbox)))
+        collector.gauge('pending_requests', lambda: total(lambda connection: len(connection.pending.queue)))
+        collector.gauge('offline_requests', lambda: total(lambda connection: len(connection.offline_requests)))
+        collector.gauge('render_backlog', lambda: len(renderer.items))
+        collector.gauge('message_cache_bytes', lambda: total(lambda connection: connection.message_cache.size))
+        collector.gauge('message_cache_hits', lambda: total(lambda connection: connection.message_cache.hits))
+        collector.gauge('message_cache_misses', lambda: total(lambda connection: connection.message_cache.misses))
+        collector.gauge('indexed_posts', lambda: total(lambda connection: len(connection.header_index)))
+        collector.gauge('prefetch_queue', lambda: total(lambda connection: len(connection.prefetcher.queue)))
+        collector.gauge('prefetched_bodies', lambda: total(lambda connection: connection.prefetcher.fetched))
+        collector.gauge('subscriptions', lambda: total(lambda connection: len(connection.subscriptions)))
+        metrics = collector
+    return metrics
+
+def total(value) -> int:
+    return sum(value(connection) for connection in tuple(connections.values()))
+
+def disable_metrics():
+    global metrics
+    metrics = None
+
+def dump_metrics(path: str):
+    # written to a temporary file first so readers never see half a dump
+    collector = metrics
+    if collector is None:
+        return
+    import json
+    temporary = path + '.tmp'
+    with open(temporary, 'w', encoding='utf-8') as dump:
+        json.dump(collector.snapshot(), dump)
+    os.replace(temporary, path)
+
+def metrics_dump_loop(path: str, interval: float):
+    while not thread_stop.wait(interval):
+        try:
+            dump_metrics(path)
+        except OSError:
+            pass
+
+def serve_metrics(port: int):
+    # Prometheus text format on http://127.0.0.1:<port>/metrics
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            collector = metrics
+            body = (collector.prometheus() if collector is not None else '').encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+DEFAULT_CONNECTION = 'default'
+# open connections by name
+connections = {}
+current = None
+
+def parse_received_message(message: bytes, connection: Connection = None):
+    if connection is None:
+        connection = current
+    event = decode_frame(message)
+    if event is None:
+        if metrics is not None:
+            metrics.count('malformed_frames')
+        return
+    pending = connection.pending
+    group_id = None
+    if event.opcode == POST:
+        group_id = pending.joining_group() or PUBLIC_GROUP
+        connection.header_index.add_event(event, group_id)
+        if archive is not None:
+            archive.add_header(event, connection.archive_group(group_id), connection.directory.names.get(group_id, ''))
+    elif event.opcode == GROUP_POST:
+        connection.header_index.add_event(event)
+        if archive is not None:
+            archive.add_header(event, connection.archive_group(event.group_id), event.group_name)
+    elif event.opcode in (JOIN, LEAVE):
+        group_id = PUBLIC_GROUP
+    prefetcher = connection.prefetcher
+    if event.opcode in (POST, GROUP_POST) and prefetcher.groups:
+        posted_in = event.group_id if event.opcode == GROUP_POST else group_id
+        # nothing to fetch for our own posts, we wrote them
+        if prefetcher.enabled(posted_in) and event.sender != pending.usernames.get(None if posted_in == PUBLIC_GROUP else posted_in):
+            prefetcher.announce(posted_in, event.id)
+    connection.directory.apply(event, pending.usernames)
+    entry = pending.resolve(event)
+    if entry is not None:
+        if event.opcode == MESSAGE:
+            key = message_key(entry)
+            connection.message_cache.put(key, event.body)
+            if archive is not None:
+                archive.add_body(connection.archive_group(key[0]), key[1], event.body)
+        # script replies are reported by the script runner, not the stream
+        if entry.internal or json_output:
             return
-        if len(tokens) != 4:
-            with print_lock:
-                print("\nUsage: grouppost <group_id> <subject> <message>\n> ", end='', flush=True)
+    else:
+        connection.subscriptions.publish(event, group_id)
+    if json_output:
+        emit({'type': 'event', **connection.tag(), **event_record(event)})
+        return
+    renderer.event(event, group_id, connection.name if len(connections) > 1 else None)
+
+class BulletinClient:
+    # asyncio client for library use, one connection per instance.
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, timeout: float = 10.0, cache: MessageCache = None, directory: Directory = None):
+        import asyncio
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.decoder = FrameDecoder()
+        # requests time out in request() instead
+        self.pending = PendingRequests(timeout=None)
+        self.cache = MessageCache() if cache is None else cache
+        self.directory = Directory() if directory is None else directory
+        self.pending.on_complete = self.directory.finished
+        self.events = asyncio.Queue()
+        self.subscriptions = Subscriptions()
+        self.extensions = frozenset()
+        self.closed = False
+        self.malformed = 0
+        self.read_task = asyncio.get_running_loop().create_task(self.read_loop())
+
+    @classmethod
+    async def connect(cls, host: str, port: int, timeout: float = 10.0, cache: MessageCache = None, directory: Directory = None, negotiate: bool = False):
+        import asyncio
+        reader, writer = await asyncio.open_connection(host, port)
+        client = cls(reader, writer, timeout, cache, directory)
+        if negotiate:
+            await client.negotiate()
+        return client
+
+    async def negotiate(self, extensions: tuple = EXTENSIONS):
+        # legacy servers ignore HELLO and stay on plain frames
+        try:
+            reply = await self.request(HELLO, ','.join(extensions))
+        except ServerError:
+            return self.extensions
+        self.extensions = frozenset(reply.features.split(',')) & frozenset(extensions)
+        return self.extensions
+
+    async def read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(MAX_FRAME_SIZE)
+                if not data:
+                    break
+                self.decoder.feed(data)
+                for frame in self.decoder.frames():
+                    self.handle_event(decode_frame(frame))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.closed = True
+            self.pending.fail_all(ConnectionError("connection closed"))
+            self.directory.forget()
+            self.subscriptions.close()
+            self.events.put_nowait(None)
+
+    def handle_event(self, event: Event):
+        if event is None:
+            self.malformed += 1
             return
-        group_id = tokens[1]
-        subject = tokens[2]
-        message = tokens[3]
-        group_post(group_id, subject, message)
-    elif cmd == 'groupusers':
-        if not active_connection:
-            with print_lock:
-                print("\nNot connected to any server. Use 'connect <ip> <port>' first.\n> ", end='', flush=True)
+        self.directory.apply(event, self.pending.usernames)
+        group_id = None
+        if event.opcode == POST:
+            group_id = self.pending.joining_group() or PUBLIC_GROUP
+        elif event.opcode in (JOIN, LEAVE):
+            group_id = PUBLIC_GROUP
+        entry = self.pending.resolve(event)
+        if entry is None:
+            self.events.put_nowait(event)
+            self.subscriptions.publish(event, group_id)
+        elif event.opcode == MESSAGE:
+            self.cache.put(message_key(entry), event.body)
+
+    async def send(self, frame: bytes):
+        if self.closed:
+            raise ConnectionError("connection is closed")
+        self.writer.write(frame)
+        await self.writer.drain()
+
+    async def request(self, opcode: int, *fields: str, timeout: float = None):
+        import asyncio
+        if self.closed:
+            raise ConnectionError("connection is closed")
+        frame = encode_frame(opcode, *fields)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.track(opcode, fields, future)
+        self.writer.write(frame)
+        if opcode in BARRIERED:
+            self.pending.track(GROUPS, (), loop.create_future(), internal=True)
+            self.writer.write(encode_frame(GROUPS))
+        await self.writer.drain()
+        # the entry stays queued after a timeout so later replies still line up
+        return await asyncio.wait_for(asyncio.shield(future), self.timeout if timeout is None else timeout)
+
+    async def join(self, username: str, timeout: float = None):
+        return await self.request(JOIN, username, timeout=timeout)
+
+    async def group_join(self, group_id: str, username: str, timeout: float = None):
+        return await self.request(GROUP_JOIN, group_id, username, timeout=timeout)
+
+    async def post(self, subject: str, message: str, timeout: float = None) -> PostEvent:
+        return await self.request(POST, subject, message, timeout=timeout)
+
+    async def group_post(self, group_id: str, subject: str, message: str, timeout: float = None) -> GroupPostEvent:
+        return await self.request(GROUP_POST, group_id, subject, message, timeout=timeout)
+
+    async def users(self, timeout: float = None) -> UsersEvent:
+        return self.directory.users(PUBLIC_GROUP) or await self.request(USERS, timeout=timeout)
+
+    async def group_users(self, group_id: str, timeout: float = None) -> GroupUsersEvent:
+        return self.directory.users(group_id) or await self.request(GROUP_USERS, group_id, timeout=timeout)
+
+    async def leave(self, timeout: float = None):
+        return await self.request(LEAVE, timeout=timeout)
+
+    async def group_leave(self, group_id: str, timeout: float = None):
+        return await self.request(GROUP_LEAVE, group_id, timeout=timeout)
+
+    async def message(self, id: str, timeout: float = None) -> MessageEvent:
+        body = self.cache.get((PUBLIC_GROUP, id))
+        if body is not None:
+            return MessageEvent(body)
+        return await self.request(MESSAGE, id, timeout=timeout)
+
+    async def group_message(self, group_id: str, msg_id: str, timeout: float = None) -> MessageEvent:
+        body = self.cache.get((group_id, msg_id))
+        if body is not None:
+            return MessageEvent(body)
+        return await self.request(GROUP_MESSAGE, group_id, msg_id, timeout=timeout)
+
+    async def groups(self, timeout: float = None) -> GroupsEvent:
+        return await self.request(GROUPS, timeout=timeout)
+
+    def subscribe(self, opcodes=None, group_id: str = None, sender: str = None, size: int = SUBSCRIBER_QUEUE_SIZE, policy: str = SUBSCRIBER_POLICY) -> Subscription:
+        return self.subscriptions.subscribe(opcodes, group_id, sender, size, policy)
+
+    async def close(self):
+        if not self.closed:
+            try:
+                await self.send(encode_frame(EXIT))
+            except (ConnectionError, OSError):
+                pass
+        self.closed = True
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+        self.read_task.cancel()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.events.get()
+        if event is None:
+            # keep the end marker around for any other iterator
+            self.events.put_nowait(None)
+            raise StopAsyncIteration
+        return event
+
+SEARCH_FILTERS = {
+    'from': 'sender',
+    'group': 'group_id',
+    'subject': 'subject',
+    'prefix': 'prefix',
+    'after': 'since',
+    'before': 'until',
+}
+
+def print_search_body(group_id: str, id: str, future: Future):
+    try:
+        text = render_message(future.result())
+    except Exception as e:
+        text = f"\n\033[91mCould not fetch {id}: {e}\033[0m"
+    show(f"\n[{group_id}] ID: {id}" + text)
+
+def tokenize(command: str):
+    # "quoted text" stays one token, None if a quote is left open
+    if '"' not in command:
+        return command.split()
+    pieces = command.split('"')
+    if len(pieces) % 2 == 0:
+        return None
+    tokens = []
+    glue = False
+    for index, piece in enumerate(pieces):
+        if index % 2:
+            if glue:
+                tokens[-1] += piece
+            else:
+                tokens.append(piece)
+            glue = True
+            continue
+        if not piece:
+            continue
+        words = piece.split()
+        if glue and not piece[0].isspace():
+            tokens[-1] += words.pop(0)
+        tokens.extend(words)
+        glue = not piece[-1].isspace()
+    return tokens
+
+def parse_usage(usage: str) -> tuple:
+    # <name> required, [<name>] optional, [a|b] an optional keyword,
+    # <name...> the rest of the line, [<name> ...] any number of words
+    params = []
+    words = usage.split()[1:]
+    for index, word in enumerate(words):
+        name = word.strip('[]<>.')
+        if word.startswith('[<') and words[index+1:index+2] == ['...]']:
+            params.append(('list', name, None))
+            break
+        if word.startswith('[<'):
+            params.append(('optional', name, None))
+        elif word.startswith('['):
+            params.append(('keyword', name, frozenset(name.split('|'))))
+        elif word.endswith('...>'):
+            params.append(('rest', name, None))
+        else:
+            params.append(('required', name, None))
+    return tuple(params)
+
+class Command:
+    # One entry of the command table; the usage string declares the arguments.
+    __slots__ = ('name', 'usage', 'help', 'params', 'required_after', 'handler', 'builder', 'connected', 'types', 'scriptable')
+
+    def __init__(self, usage: str, help: str, handler=None, builder=None, connected: bool = True, types: dict = None, scriptable: bool = True):
+        self.name = usage.split()[0]
+        self.usage = usage
+        self.help = help
+        self.params = parse_usage(usage)
+        # required words after each parameter, optionals only take spare words
+        self.required_after = [sum(kind in ('required', 'rest') for kind, _, _ in self.params[index+1:]) for index in range(len(self.params))]
+        self.handler = handler
+        self.builder = builder
+        self.connected = connected
+        self.types = types or {}
+        self.scriptable = scriptable
+
+    def bind(self, words: list):
+        # the arguments for these words, None if they don't fit the usage
+        arguments = []
+        index = 0
+        for position, (kind, name, keywords) in enumerate(self.params):
+            word = words[index] if index < len(words) else None
+            if kind == 'required':
+                if word is None:
+                    return None
+                arguments.append(word)
+                index += 1
+            elif kind == 'rest':
+                if word is None:
+                    return None
+                arguments.append(' '.join(words[index:]))
+                index = len(words)
+            elif kind == 'list':
+                arguments.append(words[index:])
+                index = len(words)
+            elif kind == 'keyword':
+                taken = word is not None and word in keywords
+                arguments.append(word if taken else None)
+                index += taken
+            elif len(words) - index > self.required_after[position]:
+                arguments.append(word)
+                index += 1
+            else:
+                arguments.append(None)
+        if index != len(words):
+            return None
+        for position, (_, name, _) in enumerate(self.params):
+            convert = self.types.get(name)
+            if convert is not None and arguments[position] is not None:
+                try:
+                    arguments[position] = convert(arguments[position])
+                except ValueError:
+                    raise ValueError(f"{name.capitalize()} must be {'an integer' if convert is int else 'a number'}.") from None
+        return arguments
+
+def connect_command(connection: Connection, name: str, ip: str, port: int):
+    if name is not None:
+        connection = connections.get(name) or Connection(name)
+    if connection.active:
+        show(f"\n{connection.prefix()}Already connected to a server.")
+        return
+    try:
+        connection.open(ip, port)
+    except Exception as e:
+        show(f"\nFailed to connect to {ip}:{port} - {e}")
+        return
+    promote(connection)
+    show(f"\n{connection.prefix()}Connected to {ip}:{port}")
+
+def use_command(connection: Connection, name: str):
+    global current
+    if name not in connections:
+        show(f"\nNo connection named {name}, see 'connections' for the names.")
+        return
+    current = connections[name]
+    show(f"\nCommands now go to {current.name}.")
+
+def connections_command(connection: Connection):
+    if not connections:
+        show("\nNo connections.")
+        return
+    lines = []
+    for named in connections.values():
+        if named.address is None:
+            state = "closed"
+        elif named.active:
+            state = f"{named.address[0]}:{named.address[1]}"
+            if named.extensions:
+                state += f" ({', '.join(sorted(named.extensions))})"
+        else:
+            state = "reconnecting"
+        marker = '*' if named is current else ' '
+        lines.append(f"\n{marker} {named.name}: {state}, {len(named.pending.queue)} waiting for replies")
+    show(''.join(lines))
+
+def disconnect_command(connection: Connection):
+    connection.close()
+
+def search_command(connection: Connection, filters: list):
+    conditions = {}
+    fetch_bodies = False
+    for token in filters:
+        key, _, value = token.partition(':')
+        if token == 'body':
+            fetch_bodies = True
+        elif value and key in SEARCH_FILTERS:
+            conditions[SEARCH_FILTERS[key]] = value
+        else:
+            show("\nUsage: search [from:<user>] [group:<group_id>] [subject:<text>] [prefix:<text>] [after:<date>] [before:<date>] [body]")
             return
-        if len(tokens) != 2:
-            with print_lock:
-                print("\nUsage: groupjoin <group_id>\n> ", end='', flush=True)
+    index = connection.header_index
+    rows = index.search(**conditions)
+    lines = [f"\n{len(rows)} of {len(index)} posts match"]
+    for row in rows:
+        group_id, id, sender, date, subject = index.header(row)
+        lines.append(f"\n[{group_id}] ID: {id} From: {sender} Date: {date} Subject: {subject}")
+    show(''.join(lines))
+    if fetch_bodies and connection.address is not None:
+        for row in rows:
+            group_id, id = index.group_ids[row], index.ids[row]
+            if group_id == PUBLIC_GROUP:
+                future = cached_request(group_id, id) or send_request(MESSAGE, id, internal=True)
+            else:
+                future = cached_request(group_id, id) or send_request(GROUP_MESSAGE, group_id, id, internal=True)
+            future.add_done_callback(lambda future, group_id=group_id, id=id: print_search_body(group_id, id, future))
+
+def archive_command(connection: Connection, action: str, group_ids: list):
+    if archive is None:
+        show("\nNo archive. Start the client with --archive <path> to keep one.")
+    elif action is None:
+        if group_ids:
+            show(f"\nUsage: {COMMANDS['archive'].usage}")
             return
-        group_id = tokens[1]
-        group_users(group_id)
-    elif cmd == 'groupmessage':
-        if not active_connection:
-            with print_lock:
-                print("\nNot connected to any server. Use 'connect <ip> <port>' first.\n> ", end='', flush=True)
+        show(f"\nArchive {archive.path}: {len(archive.offsets)} records, {archive.size} bytes")
+    else:
+        # groups are archived under their server, see Connection.archive_group
+        if connection.server is not None:
+            group_ids = [connection.archive_group(group_id) for group_id in group_ids]
+        before, after = archive.compact(group_ids)
+        show(f"\nArchive compacted from {before} to {after} bytes")
+
+def prefetch_command(connection: Connection, action: str, group_ids: list):
+    prefetcher = connection.prefetcher
+    if action == 'on':
+        prefetcher.groups.update(group_ids or ['*'])
+    elif action == 'off' and group_ids:
+        prefetcher.groups.difference_update(group_ids)
+        for group_id in group_ids:
+            prefetcher.forget(group_id)
+    elif action == 'off':
+        prefetcher.groups.clear()
+        prefetcher.forget()
+    elif group_ids:
+        show(f"\nUsage: {COMMANDS['prefetch'].usage}")
+        return
+    if not prefetcher.groups:
+        show("\nPrefetch is off.")
+    else:
+        enabled = 'all groups' if '*' in prefetcher.groups else ', '.join(sorted(prefetcher.groups))
+        show(f"\nPrefetching bodies for {enabled}: {len(prefetcher.queue)} queued, "
+             f"{prefetcher.in_flight} in flight, {prefetcher.fetched} fetched, {prefetcher.failed} failed")
+
+def stats_command(connection: Connection, action: str):
+    if action is not None:
+        if action != 'on':
+            disable_metrics()
+        if action != 'off':
+            enable_metrics()
+        show(f"\nMetrics {'off' if metrics is None else 'on'}.")
+    elif metrics is None:
+        show("\nMetrics are off. Use 'stats on' or start the client with --metrics.")
+    else:
+        show(render_stats(metrics.snapshot()))
+
+def help_command(connection: Connection):
+    lines = ["@<name> <command>, @all <command>: Send one command to the named connection, or to every connection"]
+    lines.extend(f"{command.usage}: {command.help}" for _, command in sorted(COMMANDS.items()))
+    show("\nAvailable commands:\n\t" + "\n\t".join(lines))
+
+def quit_command(connection: Connection):
+    exit_command()
+
+COMMANDS = {command.name: command for command in [
+    Command('connect [<name>] <ip> <port>', "Connects to a server on the given ip address and port, optionally as a named connection",
+            handler=connect_command, connected=False, types={'port': int}),
+    Command('connections', "Lists the open connections, * marks where commands go", handler=connections_command, connected=False),
+    Command('use <name>', "Send commands to the named connection from now on", handler=use_command, connected=False),
+    Command('disconnect', "Leave all groups on the current server and close the connection", handler=disconnect_command),
+    Command('join <username>', "Joins the public group with a given username", builder=join),
+    Command('post <subject> <body...>', "Posts to the public group", builder=post),
+    Command('users', "List users of the public group", builder=users),
+    Command('leave', "Leaves the public group", builder=leave),
+    Command('message <id>', "View a message from the public group", builder=message_command),
+    Command('groups', "Lists all available groups to join", builder=groups),
+    Command('groupjoin <group_id> <username>', "Joins a private group with a given username", builder=group_join),
+    Command('grouppost <group_id> <subject> <body...>', "Posts to a private group", builder=group_post),
+    Command('groupusers <group_id>', "List users of a private group", builder=group_users),
+    Command('groupleave <group_id>', "Leaves a private group", builder=group_leave),
+    Command('groupmessage <group_id> <id>', "View a message from a private group", builder=group_message_command),
+    Command('search [<filters> ...]', "Search the posts seen so far by from:<user> group:<group_id> subject:<text> "
+            "prefix:<text> after:<date> before:<date>, body also fetches each match", handler=search_command, connected=False),
+    Command('archive [compact] [<group_id> ...]', "Show the archive, or compact it dropping the given groups of this server",
+            handler=archive_command, connected=False),
+    Command('prefetch [on|off] [<group_id> ...]', "Fetch bodies of new posts in the background, for the given groups or all",
+            handler=prefetch_command, connected=False),
+    Command('stats [on|off|reset]', "Show or control the client's performance metrics", handler=stats_command, connected=False),
+    Command('help', "View commands", handler=help_command, connected=False, scriptable=False),
+    Command('exit', "Leave all groups and quit program", handler=quit_command, connected=False),
+]}
+
+def parse_command(command: str):
+    tokens = tokenize(command)
+    # if no second quote, raise invalid command
+    if tokens is None:
+        renderer.show("\nInvalid command: unmatched quotes.")
+        return
+    if not tokens:
+        return
+    if not tokens[0].startswith('@'):
+        execute(tokens)
+        return
+    # @name <command> sends one command to a connection, @all to every one
+    name = tokens[0][1:]
+    if len(tokens) == 1:
+        renderer.show("\nUsage: @<name> <command> or @all <command>")
+    elif name == 'all':
+        for connection in tuple(connections.values()):
+            if connection.address is not None:
+                with addressed(connection):
+                    execute(tokens[1:])
+    elif name in connections:
+        with addressed(connections[name]):
+            execute(tokens[1:])
+    elif tokens[1].lower() == 'connect':
+        execute(['connect', name] + tokens[2:])
+    else:
+        renderer.show(f"\nNo connection named {name}. Use 'connect {name} <ip> <port>' first.")
+
+def execute(tokens: list):
+    command = COMMANDS.get(tokens[0].lower())
+    if command is None:
+        renderer.show("\nUnknown command.")
+        return
+    connection = target()
+    if command.connected and connection.address is None:
+        renderer.show("\nNot connected to any server. Use 'connect <ip> <port>' first.")
+        return
+    try:
+        arguments = command.bind(tokens[1:])
+    except ValueError as e:
+        renderer.show(f"\n{e}")
+        return
+    if arguments is None:
+        renderer.show(f"\nUsage: {command.usage}")
+        return
+    if command.handler is not None:
+        command.handler(connection, *arguments)
+        return
+    future = command.builder(*arguments)
+    # local answers never reach the reader thread
+    if getattr(future, 'local', False):
+        renderer.event(future.result(), None, connection.name if len(connections) > 1 else None)
+
+def run_command(command: str):
+    try:
+        parse_command(command)
+    except SendQueueFull as e:
+        renderer.show(f"\n\033[91mServer is not keeping up, command not sent ({e}).\033[0m")
+    except ValueError as e:
+        renderer.show(f"\n\033[91m{e}\033[0m")
+
+# parameter names double as the keys of a JSON line
+SCRIPT_COMMANDS = {name: command for name, command in COMMANDS.items() if command.scriptable}
+SCRIPT_COMMANDS['sleep'] = Command('sleep <seconds>', "Pause the script", connected=False, types={'seconds': float})
+
+class ScriptRunner:
+    # Runs commands from a file or pipe; every reply becomes a result record.
+    def __init__(self, rate: float = 0.0, concurrency: int = 0):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.slots = threading.BoundedSemaphore(concurrency) if concurrency > 0 else None
+        self.condition = threading.Condition()
+        self.next_at = time.monotonic()
+        self.outstanding = 0
+        self.sent = 0
+        self.ok = 0
+        self.failed = 0
+        self.invalid = 0
+
+    def parse(self, line: str) -> tuple:
+        if line.startswith('{'):
+            import json
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError("expected a JSON object")
+            recipient = record.get('connection')
+            command = SCRIPT_COMMANDS.get(str(record.get('op', '')).lower())
+            if command is None:
+                raise ValueError(f"unknown op {record.get('op')!r}")
+            # the record's values become the words of a command line
+            words = []
+            for kind, name, _ in command.params:
+                value = record.get(name)
+                if kind == 'list':
+                    words.extend(str(item) for item in (value or ()))
+                elif value is not None:
+                    words.append(str(value))
+                elif kind in ('required', 'rest'):
+                    raise ValueError(f"{command.name} needs {name}")
+            recipient = None if recipient is None else str(recipient)
+        else:
+            words = tokenize(line)
+            if words is None:
+                raise ValueError("unmatched quotes")
+            recipient = None
+            if words[0].startswith('@'):
+                recipient = words.pop(0)[1:]
+                if not words:
+                    raise ValueError("usage: @<name> <command>")
+            name = words.pop(0).lower()
+            command = SCRIPT_COMMANDS.get(name)
+            if command is None:
+                raise ValueError(f"unknown command {name!r}")
+        arguments = command.bind(words)
+        if arguments is None:
+            raise ValueError(f"usage: {command.usage}")
+        return recipient, command, arguments
+
+    def run(self, lines) -> int:
+        count = 0
+        for count, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                recipient, command, arguments = self.parse(line)
+                if command.name == 'exit':
+                    break
+                if recipient == 'all':
+                    for connection in tuple(connections.values()):
+                        if connection.address is not None:
+                            self.dispatch(count, connection, command, arguments)
+                elif recipient is None:
+                    self.dispatch(count, current, command, arguments)
+                elif recipient in connections:
+                    self.dispatch(count, connections[recipient], command, arguments)
+                elif command.name == 'connect':
+                    self.dispatch(count, Connection(recipient), command, arguments)
+                else:
+                    raise ValueError(f"no connection named {recipient!r}")
+            except (OSError, ValueError) as e:
+                self.invalid += 1
+                emit({'type': 'invalid', 'line': count, 'error': str(e)})
+        return count
+
+    def dispatch(self, number: int, connection: Connection, command: Command, arguments: list):
+        if command.name == 'connect':
+            name, host, port = arguments
+            if name is not None:
+                connection = connections.get(name) or Connection(name)
+            if connection.active:
+                raise ValueError("already connected to a server")
+            connection.open(host, port)
+            promote(connection)
+            emit({'type': 'connected', 'line': number, **connection.tag(), 'host': host, 'port': port})
             return
-        if len(tokens) != 3:
-            with print_lock:
-                print("\nUsage: groupmessage <group_id> <msg_id>\n> ", end='', flush=True)
+        if command.name == 'sleep':
+            time.sleep(arguments[0])
+            self.next_at = time.monotonic()
             return
-        group_id = tokens[1]
-        message_id = tokens[2]
-        group_message_command(group_id, message_id)
-    elif cmd == 'groupleave':
-        if not active_connection:
-            with print_lock:
-                print("\nNot connected to any server. Use 'connect <ip> <port>' first.\n> ", end='', flush=True)
+        if command.name == 'stats' and arguments[0] is None:
+            emit({'type': 'stats', 'line': number, **enable_metrics().snapshot()})
             return
-        if len(tokens) != 2:
-            with print_lock:
-                print("\nUsage: groupleave <group_id>\n> ", end='', flush=True)
+        if command.handler is not None:
+            if command.connected and connection.address is None:
+                raise ValueError("not connected to a server")
+            # what the handler shows goes into its result record
+            local_state.output = []
+            try:
+                with addressed(connection):
+                    command.handler(connection, *arguments)
+            finally:
+                output, local_state.output = local_state.output, None
+            emit({'type': 'result', 'line': number, **connection.tag(), 'op': command.name, 'ok': True, 'output': '\n'.join(output)})
             return
-        group_id = tokens[1]
-        group_leave(group_id)
-        with print_lock:
-            print("\n> ", end='', flush=True)
-    elif cmd == 'help':
-        with print_lock:
-            print("\nAvailable commands:\n\t", end='', flush=True)
-            print("connect <ip> <port>: Connects to a server on the given ip address and port\n\t", end='', flush=True)
-            print("exit: Leave all groups and quit program\n\t", end='', flush=True)
-            print("groupjoin <group_id> <username>: Joins a private group with a given username\n\t", end='', flush=True)
-            print("groupleave <group_id>: Leaves a private group\n\t", end='', flush=True)
-            print("groupmessage <group_id> <message_id>: View a message from a private group\n\t", end='', flush=True)
-            print("grouppost <group_id< <subject> <body>: Posts to a private group\n\t", end='', flush=True)
-            print("groups: Lists all available groups to join\n\t", end='', flush=True)
-            print("groupusers <group_id>: List users of a private group \n\t", end='', flush=True)
-            print("help: View commands\n\t", end='', flush=True)
-            print("join <username>: Joins the public group with a given username\n\t", end='', flush=True)
-            print("leave: Leaves the public group\n\t", end='', flush=True)
-            print("message <message_id>: View a message from the public group\n\t", end='', flush=True)
-            print("post <subject> <body>: Posts to the public group\n\t", end='', flush=True)
-            print("users: List users of the public group\n> ", end='', flush=True)
+        if self.interval:
+            self.next_at += self.interval
+            delay = self.next_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        if self.slots is not None:
+            self.slots.acquire()
+        with self.condition:
+            self.outstanding += 1
+        started = time.perf_counter()
+        try:
+            with addressed(connection):
+                future = command.builder(*arguments)
+        except BaseException:
+            self.done()
+            raise
+        self.sent += 1
+        future.add_done_callback(lambda future: self.finish(number, connection, command.name, started, future))
+
+    def finish(self, number: int, connection: Connection, command: str, started: float, future: Future):
+        record = {'type': 'result', 'line': number, **connection.tag(), 'op': command,
+                  'latency_ms': round((time.perf_counter() - started) * 1000, 3)}
+        error = future.exception()
+        if error is None:
+            record['ok'] = True
+            if future.result() is not None:
+                record['reply'] = event_record(future.result())
+        else:
+            record['ok'] = False
+            record['error'] = str(error)
+        emit(record)
+        self.done(error is None)
+
+    def done(self, ok: bool = None):
+        if self.slots is not None:
+            self.slots.release()
+        with self.condition:
+            if ok is not None:
+                if ok:
+                    self.ok += 1
+                else:
+                    self.failed += 1
+            self.outstanding -= 1
+            if self.outstanding == 0:
+                self.condition.notify_all()
+
+    def drain(self, timeout: float) -> bool:
+        with self.condition:
+            return self.condition.wait_for(lambda: self.outstanding == 0, timeout)
+
+def run_script(args: argparse.Namespace) -> dict:
+    global json_output
+    json_output = True
+    renderer.prompt = False
+    global outbox_policy
+    # a script should wait for the server to catch up rather than lose commands
+    outbox_policy = current.outbox.policy = 'block'
+    runner = ScriptRunner(args.rate, args.concurrency)
+    started = time.monotonic()
+    if args.host is not None:
+        try:
+            current.open(args.host, args.port)
+        except OSError as e:
+            emit({'type': 'invalid', 'line': 0, 'error': f"could not connect to {args.host}:{args.port}: {e}"})
+            return {'type': 'summary', 'lines': 0, 'sent': 0, 'ok': 0, 'failed': 0, 'invalid': 1, 'unfinished': 0, 'elapsed': 0.0}
+        emit({'type': 'connected', 'line': 0, 'host': args.host, 'port': args.port})
+    if args.script is None or args.script == '-':
+        lines = runner.run(sys.stdin)
     else:
-        with print_lock:
-            print("\nUnknown command.\n> ", end='', flush=True)
+        with open(args.script, encoding='utf-8') as script:
+            lines = runner.run(script)
+    runner.drain(args.timeout)
+    if args.linger > 0:
+        time.sleep(args.linger)
+    exit_command()
+    return {
+        'type': 'summary',
+        'lines': lines,
+        'sent': runner.sent,
+        'ok': runner.ok,
+        'failed': runner.failed,
+        'invalid': runner.invalid,
+        'unfinished': runner.outstanding,
+        'elapsed': round(time.monotonic() - started, 3),
+    }
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Bulletin board client. Interactive unless given a script or a pipe on stdin.")
+    parser.add_argument('--script', help="file of commands to run, '-' for stdin; output is one JSON object per line")
+    parser.add_argument('--host', help="connect to this server before running the script")
+    parser.add_argument('--port', type=int, default=8083)
+    parser.add_argument('--rate', type=float, default=0.0, help="requests per second, 0 to send as fast as possible")
+    parser.add_argument('--concurrency', type=int, default=0, help="most requests waiting for a reply at once, 0 for no limit")
+    parser.add_argument('--timeout', type=float, default=10.0, help="seconds to wait for outstanding replies at the end")
+    parser.add_argument('--linger', type=float, default=0.0, help="seconds to keep reporting server events after the script")
+    parser.add_argument('--archive', help="keep received headers and fetched bodies in this file across runs")
+    parser.add_argument('--prefetch', help="comma separated groups to fetch new post bodies for in the background, '*' for all")
+    parser.add_argument('--metrics', action='store_true', help="collect performance metrics from the start, see the stats command")
+    parser.add_argument('--metrics-file', help="write a JSON metrics snapshot to this file periodically")
+    parser.add_argument('--metrics-interval', type=float, default=10.0, help="seconds between metrics snapshots")
+    parser.add_argument('--metrics-port', type=int, help="serve Prometheus metrics on 127.0.0.1:<port>/metrics")
+    return parser.parse_args()
 
 def windows_command_loop():
     import msvcrt
-    print("> ", end='', flush=True)
+    renderer.edit('', 0)
     lpos = 0
     command = ''
     previous_commands = []
@@ -441,15 +3030,15 @@ def windows_command_loop():
     while True:
         char = msvcrt.getwch()
         if char == '\r':
+            renderer.submit(command)
             if command.strip() == '':
-                with print_lock:
-                    print("\n> ", end='', flush=True)
+                command = ''
                 lpos = 0
                 continue
             if command.strip().lower() == 'exit':
                 exit_command()
                 break
-            parse_command(command)
+            run_command(command)
             prev_cmd_index = -1
             previous_commands.append(command)
             command = ''
@@ -462,72 +3051,42 @@ def windows_command_loop():
                 lpos -= 1
                 new_command = command[0:lpos] + command[lpos+1:]
                 command = new_command
-                # remove character in place and reprint rest of line
-                with print_lock:
-                    print('\b', end='', flush=True)
-                    print(command[lpos:] + ' ', end='', flush=True)
-                    print('\b' * (len(command) - lpos + 1), end='', flush=True)
         elif char == '\xe0':
             arrow = msvcrt.getwch()
             if arrow == 'K':  # left arrow
                 if lpos > 0:
-                    with print_lock:
-                        print('\b', end='', flush=True)
                     lpos -= 1
             elif arrow == 'M':  # right arrow
                 if lpos < len(command):
-                    with print_lock:
-                        print(command[lpos], end='', flush=True)
                     lpos += 1
             elif arrow == 'H':  # up arrow
                 if previous_commands:
-                    # clear current line
                     if abs(prev_cmd_index) <= len(previous_commands):
-                        with print_lock:
-                            print('\b' * lpos + ' ' * len(command) + '\b' * len(command), end='', flush=True)
                         command = previous_commands[prev_cmd_index]
                         prev_cmd_index -= 1
-                        
-                        with print_lock:
-                            print(command, end='', flush=True)
                         lpos = len(command)
             elif arrow == 'P':  # down arrow
                 if previous_commands and prev_cmd_index < -1:
-                    # clear current line
-                    with print_lock:
-                        print('\b' * lpos + ' ' * len(command) + '\b' * len(command), end='', flush=True)
                     prev_cmd_index += 1
                     command = previous_commands[prev_cmd_index]
-                    
-                    with print_lock:
-                        print(command, end='', flush=True)
                     lpos = len(command)
                 elif prev_cmd_index == -1:
-                    # clear current line
-                    with print_lock:
-                        print('\b' * lpos + ' ' * len(command) + '\b' * len(command), end='', flush=True)
                     command = ''
                     lpos = 0
         #ctrl c
         elif char == '\x03':
-            with print_lock:
-                print("^C")
+            renderer.submit(command + "^C")
             exit_command()
             break
         else:
             lpos += 1
             command = command[:lpos-1] + char + command[lpos-1:]
-            with print_lock:
-                print(command[lpos-1:], end='', flush=True)
-                print('\b' * (len(command) - lpos), end='', flush=True)
-            
+        renderer.edit(command, lpos)
 
 def unix_command_loop():
-    pass
-    import sys
     import termios
     import tty
-    print("> ", end='', flush=True)
+    renderer.edit('', 0)
     lpos = 0
     command = ''
     previous_commands = []
@@ -540,15 +3099,15 @@ def unix_command_loop():
         while True:
             char = sys.stdin.read(1)
             if char == '\n':
+                renderer.submit(command)
                 if command.strip() == '':
-                    with print_lock:
-                        print("\n> ", end='', flush=True)
+                    command = ''
                     lpos = 0
                     continue
                 if command.strip().lower() == 'exit':
                     exit_command()
                     break
-                parse_command(command)
+                run_command(command)
                 prev_cmd_index = -1
                 previous_commands.append(command)
                 command = ''
@@ -558,81 +3117,192 @@ def unix_command_loop():
                     lpos -= 1
                     new_command = command[0:lpos] + command[lpos+1:]
                     command = new_command
-                    with print_lock:
-                        print('\b', end='', flush=True)
-                        print(command[lpos:] + ' ', end='', flush=True)
-                        print('\b' * (len(command) - lpos + 1), end='', flush=True)
             elif char == '\x1b':  # escape sequence
                 next1 = sys.stdin.read(1)
                 if next1 == '[':
                     next2 = sys.stdin.read(1)
                     if next2 == 'D':  # left arrow
                         if lpos > 0:
-                            with print_lock:
-                                print('\b', end='', flush=True)
                             lpos -= 1
                     elif next2 == 'C':  # right arrow
                         if lpos < len(command):
-                            with print_lock:
-                                print(command[lpos], end='', flush=True)
                             lpos += 1
                     elif next2 == 'A':  # up arrow
                         if previous_commands:
                             if abs(prev_cmd_index) <= len(previous_commands):
-                                with print_lock:
-                                    print('\b' * lpos + ' ' * len(command) + '\b' * len(command), end='', flush=True)
                                 command = previous_commands[prev_cmd_index]
                                 prev_cmd_index -= 1
-                                
-                                with print_lock:
-                                    print(command, end='', flush=True)
                                 lpos = len(command)
                     elif next2 == 'B':  # down arrow
                         if previous_commands and prev_cmd_index < -1:
-                            with print_lock:
-                                print('\b' * lpos + ' ' * len(command) + '\b' * len(command), end='', flush=True)
                             prev_cmd_index += 1
                             command = previous_commands[prev_cmd_index]
-                            
-                            with print_lock:
-                                print(command, end='', flush=True)
                             lpos = len(command)
                         elif prev_cmd_index == -1:
-                            with print_lock:
-                                print('\b' * lpos + ' ' * len(command) + '\b' * len(command), end='', flush=True)
                             command = ''
                             lpos = 0
             # ctrl c
             elif char == '\x03':
-                with print_lock:
-                    print("^C")
+                renderer.submit(command + "^C")
                 exit_command()
                 break
             else:
                 lpos += 1
                 command = command[:lpos-1] + char + command[lpos-1:]
-                with print_lock:
-                    print(command[lpos-1:], end='', flush=True)
-                    print('\b' * (len(command) - lpos), end='', flush=True)
+            renderer.edit(command, lpos)
     finally:
         termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
 
+class Outcome:
+    # the part of Future post_once needs, without importing concurrent.futures
+    __slots__ = ('value', 'error', 'finished')
+
+    def __init__(self):
+        self.value = None
+        self.error = None
+        self.finished = False
+
+    def done(self) -> bool:
+        return self.finished
+
+    def set_result(self, value):
+        self.value = value
+        self.finished = True
+
+    def set_exception(self, error: Exception):
+        self.error = error
+        self.finished = True
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def exception(self):
+        return self.error
+
+def post_once(argv: list) -> int:
+    imported = time.perf_counter()
+    parser = argparse.ArgumentParser(prog='client.py post', description="Join a group, post one message and exit.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8083)
+    parser.add_argument('--user', required=True)
+    parser.add_argument('--subject', required=True)
+    parser.add_argument('--body', required=True, help="message body, '-' to read it from stdin")
+    parser.add_argument('--group', default=PUBLIC_GROUP)
+    parser.add_argument('--timeout', type=float, default=10.0, help="seconds allowed for connecting and the replies")
+    parser.add_argument('--quiet', action='store_true', help="do not print the timing")
+    args = parser.parse_args(argv)
+    body = sys.stdin.read() if args.body == '-' else args.body
+    pending = PendingRequests()
+    frames = []
+
+    def request(opcode: int, *fields: str) -> Outcome:
+        frames.append(encode_frame(opcode, *fields))
+        return pending.track(opcode, fields, Outcome()).future
+
+    try:
+        if args.group == PUBLIC_GROUP:
+            joined = request(JOIN, args.user)
+            request(GROUPS)
+            posted = request(POST, args.subject, body)
+        else:
+            joined = request(GROUP_JOIN, args.group, args.user)
+            request(GROUPS)
+            posted = request(GROUP_POST, args.group, args.subject, body)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    frames.append(encode_frame(EXIT))
+    status = 0
+    try:
+        prepared = time.perf_counter()
+        with socket.create_connection((args.host, args.port), timeout=args.timeout) as sock:
+            connected = time.perf_counter()
+            sock.sendall(b''.join(frames))
+            decoder = FrameDecoder(MAX_FRAME_SIZE)
+            deadline = connected + args.timeout
+            while not posted.done():
+                sock.settimeout(max(0.001, deadline - time.perf_counter()))
+                if decoder.recv_into(sock) == 0:
+                    raise ConnectionError("server closed the connection")
+                for frame in decoder.frames():
+                    event = decode_frame(frame)
+                    if event is not None:
+                        pending.resolve(event)
+    except socket.timeout:
+        print(f"No reply from {args.host}:{args.port} within {args.timeout:g}s.", file=sys.stderr)
+        status = 1
+    except OSError as e:
+        print(f"Could not post to {args.host}:{args.port}: {e}", file=sys.stderr)
+        status = 1
+    else:
+        # a failed join also fails the post, the join's error says why
+        error = joined.exception() or posted.exception()
+        if error is not None:
+            print(f"Error: {error}", file=sys.stderr)
+            status = 1
+        else:
+            print(posted.result().id)
+    finished = time.perf_counter()
+    if not args.quiet:
+        timing = f"{(finished - STARTED) * 1000:.1f} ms (imports {(imported - STARTED) * 1000:.1f} ms"
+        if status == 0:
+            timing += f", connect {(connected - prepared) * 1000:.1f} ms, replies {(finished - connected) * 1000:.1f} ms"
+        print(f"{timing})", file=sys.stderr)
+    return status
+
 def main():
-    global sock
     global message_thread
-    global active_connection
-    if os.name == 'nt':
+    global archive
+    global renderer
+    global current
+    if sys.argv[1:2] == ['post']:
+        sys.exit(post_once(sys.argv[2:]))
+    args = parse_arguments()
+    renderer = Renderer()
+    current = Connection(DEFAULT_CONNECTION)
+    if args.archive:
+        archive = Archive(args.archive)
+    if args.prefetch:
+        prefetch_groups.update(group_id for group_id in args.prefetch.split(',') if group_id)
+        current.prefetcher.groups.update(prefetch_groups)
+    if args.metrics or args.metrics_file or args.metrics_port:
+        enable_metrics()
+    if args.metrics_file:
+        threading.Thread(target=metrics_dump_loop, args=(args.metrics_file, args.metrics_interval), daemon=True).start()
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+    message_thread.start()
+    summary = None
+    if args.script is not None or not sys.stdin.isatty():
+        summary = run_script(args)
+    elif os.name == 'nt':
         windows_command_loop()
     else:
         # same functionality as windows but for unix
         unix_command_loop()
+    # let the writer get EXIT out before stopping
+    deadline = time.monotonic() + 1.0
+    for connection in tuple(connections.values()):
+        connection.outbox.flush(timeout=max(0.0, deadline - time.monotonic()))
     thread_stop.set()
-    try:
-        message_thread.join()
-    except:
-        pass
-    if active_connection:
-        sock.close()
+    wake()
+    stop_writer()
+    message_thread.join(timeout=1.0)
+    writer_thread.join(timeout=1.0)
+    for connection in tuple(connections.values()):
+        if connection.active:
+            connection.sock.close()
+    if args.metrics_file:
+        dump_metrics(args.metrics_file)
+    if archive is not None:
+        archive.close()
+    if summary is not None:
+        emit(summary)
+    renderer.stop()
+    if summary is not None and (summary['failed'] or summary['invalid'] or summary['unfinished']):
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
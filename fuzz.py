@@ -0,0 +1,265 @@
+import argparse
+import random
+import sys
+import time
+import traceback
+
+import client
+from client import (
+    BATCH, EVENT_SCHEMAS, HEADER, HEADER_SIZE, MAGIC, MAX_FRAME_SIZE, OPCODE_NAMES, REQUEST_FIELDS, STRING,
+    STRING_LIST, Connection, FrameDecoder, Renderer, decode_frame, decode_request, encode_event, encode_frame,
+    pack_batches, parse_received_message, unbatch,
+)
+
+# Randomized property checks for the frame codecs. A failure prints the
+# seed and the smallest input that still fails.
+
+# ascii, latin-1, the BMP without surrogates, and four-byte characters
+ALPHABETS = [
+    (0x20, 0x7E), (0x00, 0x1F), (0xA0, 0xFF), (0x100, 0xD7FF), (0xE000, 0xFFFD), (0x10000, 0x10FFFF),
+]
+
+class Failure(Exception):
+    pass
+
+def random_string(rng: random.Random, budget: int) -> str:
+    # at most budget bytes once encoded; mostly short, sometimes as long as allowed
+    if budget <= 0:
+        return ''
+    low, high = rng.choice(ALPHABETS)
+    width = len(chr(high).encode('utf-8'))
+    limit = budget // width
+    length = rng.randint(0, limit) if rng.random() < 0.1 else rng.randint(0, min(limit, 40))
+    return ''.join(chr(rng.randint(low, high)) for _ in range(length))
+
+def random_fields(rng: random.Random, count: int, budget: int) -> tuple:
+    fields = []
+    for index in range(count):
+        # each field gets an even share of what is left, plus 2 length bytes
+        share = (budget - 2 * (count - index)) // (count - index)
+        field = random_string(rng, share)
+        budget -= 2 + len(field.encode('utf-8'))
+        fields.append(field)
+    return tuple(fields)
+
+def random_request(rng: random.Random) -> tuple:
+    opcode = rng.choice(list(REQUEST_FIELDS))
+    return opcode, random_fields(rng, REQUEST_FIELDS[opcode], rng.choice((64, 1024, MAX_FRAME_SIZE - HEADER.size)))
+
+def random_event(rng: random.Random):
+    opcode = rng.choice(list(EVENT_SCHEMAS))
+    record_type, kinds = EVENT_SCHEMAS[opcode]
+    budget = rng.choice((64, 1024, MAX_FRAME_SIZE - HEADER.size)) - 2 * len(kinds)
+    values = []
+    for kind in kinds:
+        if kind == STRING:
+            value = random_string(rng, budget // 2)
+            budget -= len(value.encode('utf-8'))
+        else:
+            value = []
+            for _ in range(rng.randint(0, 30)):
+                if budget < 8:
+                    break
+                if kind == STRING_LIST:
+                    item = random_string(rng, min(budget - 2, 40))
+                    budget -= 2 + len(item.encode('utf-8'))
+                else:
+                    item = (random_string(rng, min(budget // 2 - 2, 20)), random_string(rng, min(budget // 2 - 2, 20)))
+                    budget -= 4 + len(item[0].encode('utf-8')) + len(item[1].encode('utf-8'))
+                value.append(item)
+        values.append(value)
+    return record_type(*values)
+
+def random_frame(rng: random.Random) -> bytes:
+    if rng.random() < 0.5:
+        opcode, fields = random_request(rng)
+        return bytes(encode_frame(opcode, *fields))
+    return bytes(encode_event(random_event(rng)))
+
+def mutate(rng: random.Random, frame: bytes) -> bytes:
+    data = bytearray(frame)
+    for _ in range(rng.randint(1, 4)):
+        choice = rng.random()
+        if choice < 0.4 and data:
+            data[rng.randrange(len(data))] ^= 1 << rng.randrange(8)
+        elif choice < 0.6 and len(data) > HEADER_SIZE:
+            del data[rng.randrange(HEADER_SIZE, len(data)):]
+        elif choice < 0.8 and len(data) >= HEADER_SIZE:
+            # a length that disagrees with the frame
+            data[4:6] = rng.randrange(0x10000).to_bytes(2, 'little')
+        else:
+            data[rng.randrange(len(data) + 1):0] = rng.randbytes(rng.randint(1, 16))
+    return bytes(data)
+
+def shrink(data: bytes, fails) -> bytes:
+    # drops ever smaller slices as long as the input still fails
+    size = len(data) // 2
+    while size:
+        index = 0
+        while index < len(data):
+            smaller = data[:index] + data[index+size:]
+            if fails(smaller):
+                data = smaller
+            else:
+                index += size
+        size //= 2
+    return data
+
+def raises(function, data: bytes) -> bool:
+    try:
+        function(data)
+    except Exception:
+        return True
+    return False
+
+def check_robust(name: str, function, data: bytes):
+    if raises(function, data):
+        smallest = shrink(data, lambda candidate: raises(function, candidate))
+        try:
+            function(smallest)
+        except Exception:
+            detail = traceback.format_exc(limit=-1).strip()
+        raise Failure(f"{name} raised on {smallest!r}\n{detail}")
+
+def request_round_trip(rng: random.Random):
+    opcode, fields = random_request(rng)
+    frame = encode_frame(opcode, *fields)
+    if len(frame) > MAX_FRAME_SIZE:
+        raise Failure(f"{OPCODE_NAMES[opcode]} encoded to {len(frame)} bytes")
+    decoded = decode_request(bytes(frame))
+    if decoded != (opcode, fields):
+        raise Failure(f"{OPCODE_NAMES[opcode]} {fields!r} decoded as {decoded!r}")
+
+def event_round_trip(rng: random.Random):
+    event = random_event(rng)
+    frame = bytes(encode_event(event))
+    decoded = decode_frame(frame)
+    if decoded != event:
+        raise Failure(f"{event!r} decoded as {decoded!r}")
+
+def oversize(rng: random.Random):
+    # a frame that would not fit is refused, never cut short
+    opcode = rng.choice([opcode for opcode, count in REQUEST_FIELDS.items() if count])
+    fields = ['a'] * (REQUEST_FIELDS[opcode] - 1) + ['x' * rng.randint(MAX_FRAME_SIZE - HEADER.size, 2 * MAX_FRAME_SIZE)]
+    try:
+        encode_frame(opcode, *fields)
+    except ValueError:
+        return
+    raise Failure(f"{OPCODE_NAMES[opcode]} with a {len(fields[-1])} byte field was encoded")
+
+def stream_split(rng: random.Random):
+    frames = [random_frame(rng) for _ in range(rng.randint(1, 20))]
+    how = rng.choice(('plain', 'batch', 'zlib'))
+    if how == 'plain':
+        wire = b''.join(frames)
+    else:
+        wire = b''.join(bytes(batch) for batch in pack_batches(frames, how == 'zlib'))
+    decoder = FrameDecoder(rng.choice((MAX_FRAME_SIZE, 4 * MAX_FRAME_SIZE)))
+    received = []
+    index = 0
+    while index < len(wire):
+        step = rng.choice((1, 7, HEADER_SIZE, 1000, len(wire)))
+        decoder.feed(wire[index:index+step])
+        index += step
+        received.extend(bytes(frame) for frame in decoder.frames())
+    if received != frames or decoder.discarded:
+        raise Failure(f"{how} stream of {len(frames)} frames came back as {len(received)}, {decoder.discarded} bytes discarded")
+
+def truncated(rng: random.Random):
+    # every field is needed, so a frame missing its tail is rejected whole
+    if rng.random() < 0.5:
+        opcode, fields = random_request(rng)
+        name, decode, frame = 'decode_request', decode_request, bytes(encode_frame(opcode, *fields))
+    else:
+        name, decode, frame = 'decode_frame', decode_frame, bytes(encode_event(random_event(rng)))
+    cut = frame[:rng.randrange(len(frame))]
+    check_robust('decode_frame', decode_frame, cut)
+    check_robust('decode_request', decode_request, cut)
+    decoded = decode(cut)
+    if decoded is not None:
+        raise Failure(f"{name} accepted the first {len(cut)} of {len(frame)} bytes as {decoded!r}")
+
+def garbage(rng: random.Random):
+    if rng.random() < 0.5:
+        data = mutate(rng, random_frame(rng))
+    else:
+        data = MAGIC + rng.randbytes(rng.randint(0, 64)) if rng.random() < 0.5 else rng.randbytes(rng.randint(0, 256))
+    check_robust('decode_frame', decode_frame, data)
+    check_robust('decode_request', decode_request, data)
+    check_robust('unbatch', unbatch, data)
+    check_robust('parse_received_message', receive, data)
+
+def garbage_batch(rng: random.Random):
+    # the body of a BATCH frame mangled, plain or compressed
+    frames = [random_frame(rng) for _ in range(rng.randint(1, 5))]
+    batch = bytes(pack_batches(frames, rng.random() < 0.5)[0])
+    if batch[HEADER_SIZE] != BATCH:
+        return
+    check_robust('unbatch', unbatch, mutate(rng, batch))
+    check_robust('FrameDecoder', decode_stream, mutate(rng, batch))
+
+def resync(rng: random.Random):
+    # noise without a magic number in front of a frame costs only the noise
+    noise = rng.randbytes(rng.randint(1, 300)).replace(MAGIC[:1], b'')
+    frame = random_frame(rng)
+    decoder = FrameDecoder()
+    decoder.feed(noise + frame)
+    received = [bytes(item) for item in decoder.frames()]
+    if received != [frame]:
+        raise Failure(f"{len(noise)} bytes of noise then a frame gave {len(received)} frames")
+
+connection = None
+
+def receive(data: bytes):
+    parse_received_message(data, connection)
+
+def decode_stream(data: bytes):
+    decoder = FrameDecoder()
+    decoder.feed(data)
+    for frame in decoder.frames():
+        decode_frame(frame)
+
+PROPERTIES = {
+    'request_round_trip': request_round_trip,
+    'event_round_trip': event_round_trip,
+    'oversize': oversize,
+    'stream_split': stream_split,
+    'truncated': truncated,
+    'garbage': garbage,
+    'garbage_batch': garbage_batch,
+    'resync': resync,
+}
+
+def main():
+    global connection
+    parser = argparse.ArgumentParser(description="Round-trip and robustness fuzzer for the bulletin board frame codecs")
+    parser.add_argument('--cases', type=int, default=2000, help="inputs per property")
+    parser.add_argument('--seed', type=int, help="repeat an earlier run")
+    parser.add_argument('--only', help="comma separated properties to run")
+    args = parser.parse_args()
+    seed = random.randrange(2 ** 32) if args.seed is None else args.seed
+    names = args.only.split(',') if args.only else list(PROPERTIES)
+    for name in names:
+        if name not in PROPERTIES:
+            raise SystemExit(f"unknown property: {name}")
+    client.renderer = Renderer(summary_after=None, start_thread=False)
+    connection = Connection('fuzz')
+    failed = 0
+    for name in names:
+        # every property has its own generator, so --only repeats a failure exactly
+        rng = random.Random(f"{seed}:{name}")
+        started = time.perf_counter()
+        for case in range(args.cases):
+            try:
+                PROPERTIES[name](rng)
+            except Failure as e:
+                print(f"{name}: case {case} failed (--seed {seed} --only {name})\n{e}", file=sys.stderr)
+                failed += 1
+                break
+        else:
+            print(f"{name}: {args.cases} cases ok in {time.perf_counter() - started:.2f}s")
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+import argparse
+import json
+import sys
+import timeit
+import tracemalloc
+
+import client
+from client import (
+    ERROR, EVENT_SCHEMAS, EXIT, GROUP_JOIN, GROUP_LEAVE, GROUP_MESSAGE, GROUP_POST, GROUP_USERS, GROUPS, HELLO, JOIN,
+    LEAVE, MAX_FRAME_SIZE, MESSAGE, OPCODE_NAMES, PAIR_LIST, POST, STRING, STRING_LIST, USERS, Connection, FrameDecoder,
+    Renderer, decode_frame, decode_request, encode_event, encode_frame, pack_batches, parse_received_message,
+)
+
+# Micro-benchmarks for the frame codecs, no server needed. Compare against
+# a saved report with --baseline.
+
+BODY = ("Build 4127 is green again. The flaky socket test was waiting on a "
+        "port that the previous run still held; it now binds port 0. Größe "
+        "und Geschwindigkeit sind unverändert, nur die Wartezeit ist weg. ") * 2
+NAMES = [f"user{index:02}" for index in range(20)]
+GROUP_LIST = [("Private1", "Private group 1."), ("Private2", "Private group 2."),
+              ("Private3", "Private group 3."), ("Public", "Public group for all users.")]
+
+REQUESTS = {
+    JOIN: ('alice',),
+    GROUP_JOIN: ('Private1', 'alice'),
+    POST: ('Weekly status', BODY),
+    GROUP_POST: ('Private1', 'Weekly status', BODY),
+    USERS: (),
+    GROUP_USERS: ('Private1',),
+    LEAVE: (),
+    GROUP_LEAVE: ('Private1',),
+    MESSAGE: ('msg42',),
+    GROUP_MESSAGE: ('Private1', 'msg42'),
+    EXIT: (),
+    GROUPS: (),
+    HELLO: ('batch,zlib',),
+}
+
+EVENTS = {
+    JOIN: ('alice',),
+    GROUP_JOIN: ('alice', 'Private1', 'Private group 1.'),
+    POST: ('msg42', 'alice', '2024-01-01', 'Weekly status'),
+    GROUP_POST: ('msg42', 'alice', '2024-01-01', 'Weekly status', 'Private1', 'Private group 1.'),
+    USERS: (NAMES,),
+    GROUP_USERS: (NAMES, 'Private1', 'Private group 1.'),
+    LEAVE: ('alice',),
+    GROUP_LEAVE: ('alice', 'Private1', 'Private group 1.'),
+    MESSAGE: (BODY,),
+    GROUPS: (GROUP_LIST,),
+    HELLO: ('batch,zlib',),
+    ERROR: ('Message ID not found.',),
+}
+
+class Case:
+    __slots__ = ('name', 'function', 'frames', 'size')
+
+    def __init__(self, name: str, function, frames: int, size: int):
+        self.name = name
+        self.function = function
+        # frames handled and bytes they take up, per call
+        self.frames = frames
+        self.size = size
+
+def largest_request(opcode: int, fields: tuple) -> tuple:
+    # the last field grown until the frame is MAX_FRAME_SIZE
+    room = MAX_FRAME_SIZE - len(encode_frame(opcode, *fields))
+    return fields[:-1] + (fields[-1] + 'x' * room,)
+
+def largest_event(opcode: int, values: tuple) -> tuple:
+    # lists are grown with more entries, otherwise the last string
+    record_type, kinds = EVENT_SCHEMAS[opcode]
+    values = list(values)
+    room = MAX_FRAME_SIZE - len(encode_event(record_type(*values)))
+    if STRING_LIST in kinds or PAIR_LIST in kinds:
+        slot = kinds.index(STRING_LIST) if STRING_LIST in kinds else kinds.index(PAIR_LIST)
+        width = 2 + 8 if kinds[slot] == STRING_LIST else 2 + 8 + 2 + 16
+        items = list(values[slot])
+        for index in range(room // width):
+            items.append(f"u{index:07}" if kinds[slot] == STRING_LIST else (f"g{index:07}", f"group {index:09}."))
+        values[slot] = items
+    else:
+        slot = len(kinds) - 1 - kinds[::-1].index(STRING)
+        values[slot] += 'x' * room
+    return tuple(values)
+
+def build_cases() -> list:
+    cases = []
+    for opcode, fields in REQUESTS.items():
+        name = OPCODE_NAMES[opcode].lower()
+        sizes = [('realistic', fields)]
+        if fields:
+            sizes.append(('max', largest_request(opcode, fields)))
+        for label, values in sizes:
+            frame = bytes(encode_frame(opcode, *values))
+            cases.append(Case(f"encode_request/{name}/{label}", lambda opcode=opcode, values=values: encode_frame(opcode, *values), 1, len(frame)))
+            cases.append(Case(f"decode_request/{name}/{label}", lambda frame=frame: decode_request(frame), 1, len(frame)))
+    for opcode, values in EVENTS.items():
+        name = OPCODE_NAMES[opcode].lower()
+        record_type = EVENT_SCHEMAS[opcode][0]
+        for label, fields in (('realistic', values), ('max', largest_event(opcode, values))):
+            event = record_type(*fields)
+            frame = bytes(encode_event(event))
+            cases.append(Case(f"encode_event/{name}/{label}", lambda event=event: encode_event(event), 1, len(frame)))
+            cases.append(Case(f"decode_event/{name}/{label}", lambda frame=frame: decode_frame(frame), 1, len(frame)))
+    cases.extend(stream_cases())
+    cases.extend(receive_cases())
+    return cases
+
+def stream_cases() -> list:
+    # one read's worth of post announcements, reassembled and decoded
+    frame = bytes(encode_event(EVENT_SCHEMAS[GROUP_POST][0](*EVENTS[GROUP_POST])))
+    count = MAX_FRAME_SIZE // len(frame)
+    chunk = frame * count
+    decoder = FrameDecoder()
+
+    def stream():
+        decoder.feed(chunk)
+        return [decode_frame(received) for received in decoder.frames()]
+
+    cases = [Case("stream/group_post/plain", stream, count, len(chunk))]
+    for compress in (False, True):
+        batches = b''.join(pack_batches([frame] * count, compress))
+        batch_decoder = FrameDecoder()
+
+        def batched(batches=batches, batch_decoder=batch_decoder):
+            batch_decoder.feed(batches)
+            return [decode_frame(received) for received in batch_decoder.frames()]
+
+        cases.append(Case(f"stream/group_post/{'zlib' if compress else 'batch'}", batched, count, len(batches)))
+    return cases
+
+def receive_cases() -> list:
+    # parse_received_message for broadcasts nobody asked for
+    client.renderer = Renderer(summary_after=None, start_thread=False)
+    connection = Connection('microbench')
+    cases = []
+    for opcode in (POST, GROUP_POST, JOIN, GROUP_LEAVE):
+        frame = bytes(encode_event(EVENT_SCHEMAS[opcode][0](*EVENTS[opcode])))
+        cases.append(Case(f"receive/{OPCODE_NAMES[opcode].lower()}/realistic",
+                          lambda frame=frame: parse_received_message(frame, connection), 1, len(frame)))
+    return cases
+
+def peak_bytes(function, calls: int = 5) -> int:
+    # the smallest peak over a few calls, so a stray collection does not count
+    peaks = []
+    for _ in range(calls):
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        function()
+        peaks.append(tracemalloc.get_traced_memory()[1] - start)
+    return min(peaks)
+
+def allocations(function, calls: int = 5) -> int:
+    # blocks still allocated while the result is held
+    counts = []
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    for _ in range(calls):
+        before = tracemalloc.take_snapshot().filter_traces(ignore)
+        result = function()
+        after = tracemalloc.take_snapshot().filter_traces(ignore)
+        counts.append(sum(stat.count_diff for stat in after.compare_to(before, 'lineno') if stat.count_diff > 0))
+        del result
+    return min(counts)
+
+def measure(case: Case, repeat: int, min_time: float) -> dict:
+    timer = timeit.Timer(case.function)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9)))
+    best = min([elapsed] + timer.repeat(repeat - 1, number)) / number
+    return {
+        'frames_per_call': case.frames,
+        'frame_bytes': case.size // case.frames,
+        'ns_per_frame': best / case.frames * 1e9,
+        'frames_per_sec': case.frames / best,
+        'mb_per_sec': case.size / best / 1e6,
+    }
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    # cases that got slower than the baseline allows
+    slower = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        ratio = result['ns_per_frame'] / before['ns_per_frame']
+        if ratio > 1 + tolerance:
+            slower.append((name, ratio))
+    return slower
+
+def main():
+    parser = argparse.ArgumentParser(description="Encode and decode micro-benchmarks for the bulletin board protocol")
+    parser.add_argument('--filter', default='', help="only run cases whose name contains this")
+    parser.add_argument('--repeat', type=int, default=5, help="timeit runs per case, the best one counts")
+    parser.add_argument('--min-time', type=float, default=0.05, help="seconds each run lasts at least")
+    parser.add_argument('--baseline', help="earlier report to compare with; slower cases make the exit status 1")
+    parser.add_argument('--tolerance', type=float, default=0.15, help="slowdown allowed against the baseline, 0.15 is 15%%")
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    cases = [case for case in build_cases() if args.filter in case.name]
+    results = {}
+    for case in cases:
+        results[case.name] = measure(case, args.repeat, args.min_time)
+    # memory afterwards, tracing slows every allocation down
+    tracemalloc.start()
+    for case in cases:
+        results[case.name]['peak_bytes_per_frame'] = peak_bytes(case.function) / case.frames
+        results[case.name]['allocations_per_frame'] = allocations(case.function) / case.frames
+    tracemalloc.stop()
+    report = {'python': sys.version.split()[0], 'cases': results}
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(results, json.load(f)['cases'], args.tolerance)
+        for name, ratio in slower:
+            print(f"{name}: {ratio:.2f}x the baseline time", file=sys.stderr)
+        if slower:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -474,15 +474,38 @@ int parseMessage(char* message, int sock) {
 }
 
 void connectionThread(int sock) {
+    // frames can arrive split across reads or several to a read
+    std::vector<char> pending;
     for(;;) {
-        char buffer[1024] = {0};
-        if (recv(sock, buffer, sizeof(buffer), 0) <= 0) {
+        char buffer[4096];
+        ssize_t received = recv(sock, buffer, sizeof(buffer), 0);
+        if (received <= 0) {
             std::cout << "Client disconnected." << std::endl;
             break;
         }
-        if (parseMessage(buffer, sock) == -1) {
+        pending.insert(pending.end(), buffer, buffer + received);
+        size_t offset = 0;
+        bool exiting = false;
+        while (pending.size() - offset >= 6) {
+            if (static_cast<unsigned char>(pending[offset]) != MAGIC[0] || static_cast<unsigned char>(pending[offset + 1]) != MAGIC[1] ||
+                static_cast<unsigned char>(pending[offset + 2]) != MAGIC[2] || static_cast<unsigned char>(pending[offset + 3]) != MAGIC[3]) {
+                offset++;
+                continue;
+            }
+            uint16_t body_length = (static_cast<unsigned char>(pending[offset + 5]) << 8) | static_cast<unsigned char>(pending[offset + 4]);
+            if (pending.size() - offset < 6 + static_cast<size_t>(body_length)) {
+                break;
+            }
+            if (parseMessage(&pending[offset], sock) == -1) {
+                exiting = true;
+                break;
+            }
+            offset += 6 + body_length;
+        }
+        if (exiting) {
             break;
         }
+        pending.erase(pending.begin(), pending.begin() + offset);
     }
 }
 
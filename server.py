@@ -0,0 +1,258 @@
+import argparse
+import asyncio
+
+from client import (
+    EXIT, EXTENSIONS, GROUP_JOIN, GROUP_LEAVE, GROUP_MESSAGE, GROUP_POST, GROUP_USERS, GROUPS, HELLO, JOIN, LEAVE,
+    MAX_FRAME_SIZE, MESSAGE, POST, USERS, ErrorEvent, FrameDecoder, GroupJoinEvent, GroupLeaveEvent, GroupPostEvent,
+    GroupsEvent, GroupUsersEvent, HelloEvent, JoinEvent, LeaveEvent, MessageEvent, PostEvent, UsersEvent,
+    decode_request, encode_event, pack_batches,
+)
+
+# Python stand-in for server.cpp on one asyncio loop. It also drops clients
+# that vanish without EXIT, and offers HELLO extensions.
+
+PLACEHOLDER_DATE = "2024-01-01"
+BACKLOG = 2
+
+class Group:
+    __slots__ = ('id', 'long_name', 'messages', 'order', 'clients')
+
+    def __init__(self, id: str, long_name: str):
+        self.id = id
+        self.long_name = long_name
+        self.messages = {}
+        self.order = []
+        self.clients = {}
+
+class Connection:
+    __slots__ = ('number', 'writer', 'extensions', 'queued')
+
+    def __init__(self, number: int, writer: asyncio.StreamWriter):
+        self.number = number
+        self.writer = writer
+        self.extensions = frozenset()
+        self.queued = []
+
+    def send(self, frame: bytes):
+        if self.writer.is_closing():
+            return
+        if 'batch' not in self.extensions:
+            self.writer.write(frame)
+            return
+        # sent batched once per pass of the event loop
+        if not self.queued:
+            asyncio.get_running_loop().call_soon(self.flush)
+        self.queued.append(frame)
+
+    def flush(self):
+        frames = self.queued
+        self.queued = []
+        if frames and not self.writer.is_closing():
+            self.writer.writelines(pack_batches(frames, 'zlib' in self.extensions))
+
+class BulletinServer:
+    def __init__(self):
+        self.groups = {}
+        for id, long_name in [
+            ("Public", "Public group for all users."),
+            ("Private1", "Private group 1."),
+            ("Private2", "Private group 2."),
+            ("Private3", "Private group 3."),
+        ]:
+            self.groups[id] = Group(id, long_name)
+        self.public = self.groups["Public"]
+        self.connections = 0
+        self.handlers = {
+            JOIN: self.join,
+            GROUP_JOIN: self.group_join,
+            POST: self.post,
+            GROUP_POST: self.group_post,
+            USERS: self.users,
+            GROUP_USERS: self.group_users,
+            LEAVE: self.leave,
+            GROUP_LEAVE: self.group_leave,
+            MESSAGE: self.message,
+            GROUP_MESSAGE: self.group_message,
+            GROUPS: self.list_groups,
+            HELLO: self.hello,
+        }
+
+    async def serve(self, host: str = '0.0.0.0', port: int = 8083) -> asyncio.Server:
+        return await asyncio.start_server(self.handle, host, port, backlog=1024)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        connection = Connection(self.connections, writer)
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = await reader.read(MAX_FRAME_SIZE)
+                if not data:
+                    break
+                decoder.feed(data)
+                exiting = False
+                for frame in decoder.frames():
+                    request = decode_request(frame)
+                    if request is None:
+                        continue
+                    opcode, fields = request
+                    if opcode == EXIT:
+                        exiting = True
+                        break
+                    self.handlers[opcode](connection, *fields)
+                if exiting:
+                    break
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.disconnect(connection)
+            connection.flush()
+            writer.close()
+
+    def error(self, connection: Connection, message: str):
+        connection.send(encode_event(ErrorEvent(message)))
+
+    def broadcast(self, group: Group, event):
+        frame = encode_event(event)
+        for client in group.clients:
+            client.send(frame)
+
+    def sorted_names(self, group: Group) -> list:
+        # server.cpp keys clients by socket, so they come out in connection order
+        return [group.clients[client] for client in sorted(group.clients, key=lambda client: client.number)]
+
+    def send_backlog(self, connection: Connection, group: Group):
+        for id in group.order[-BACKLOG:]:
+            sender, date, subject, _ = group.messages[id]
+            connection.send(encode_event(PostEvent(id, sender, date, subject)))
+
+    def add_message(self, group: Group, sender: str, subject: str, body: str) -> str:
+        id = f"msg{len(group.messages) + 1}"
+        group.messages[id] = (sender, PLACEHOLDER_DATE, subject, body)
+        group.order.append(id)
+        return id
+
+    def member_group(self, connection: Connection, group_id: str):
+        group = self.groups.get(group_id)
+        if group is None:
+            self.error(connection, "Group ID not found.")
+            return None
+        if connection not in group.clients:
+            self.error(connection, "Not a member of the group.")
+            return None
+        return group
+
+    def join(self, connection: Connection, username: str):
+        for client, name in self.public.clients.items():
+            if client is connection:
+                return self.error(connection, "Already joined.")
+            if name == username:
+                return self.error(connection, "Username already taken.")
+        self.broadcast(self.public, JoinEvent(username))
+        self.public.clients[connection] = username
+        self.send_backlog(connection, self.public)
+
+    def group_join(self, connection: Connection, group_id: str, username: str):
+        group = self.groups.get(group_id)
+        if group is None:
+            return self.error(connection, "Group ID not found.")
+        if connection in group.clients:
+            return self.error(connection, "Already joined.")
+        if username in group.clients.values():
+            return self.error(connection, "Username already taken.")
+        self.broadcast(group, GroupJoinEvent(username, group.id, group.long_name))
+        group.clients[connection] = username
+        # server.cpp sends a group's backlog as plain POST frames too
+        self.send_backlog(connection, group)
+
+    def post(self, connection: Connection, subject: str, body: str):
+        sender = self.public.clients.get(connection)
+        if sender is None:
+            return self.error(connection, "Not a member of the public group.")
+        id = self.add_message(self.public, sender, subject, body)
+        self.broadcast(self.public, PostEvent(id, sender, PLACEHOLDER_DATE, subject))
+
+    def group_post(self, connection: Connection, group_id: str, subject: str, body: str):
+        group = self.member_group(connection, group_id)
+        if group is None:
+            return
+        sender = group.clients[connection]
+        id = self.add_message(group, sender, subject, body)
+        self.broadcast(group, GroupPostEvent(id, sender, PLACEHOLDER_DATE, subject, group.id, group.long_name))
+
+    def users(self, connection: Connection):
+        if connection not in self.public.clients:
+            return self.error(connection, "Not a member of the public group.")
+        connection.send(encode_event(UsersEvent(self.sorted_names(self.public))))
+
+    def group_users(self, connection: Connection, group_id: str):
+        group = self.member_group(connection, group_id)
+        if group is None:
+            return
+        connection.send(encode_event(GroupUsersEvent(self.sorted_names(group), group.id, group.long_name)))
+
+    def leave(self, connection: Connection):
+        username = self.public.clients.pop(connection, None)
+        if username is None:
+            return self.error(connection, "Not a member of the public group.")
+        self.broadcast(self.public, LeaveEvent(username))
+
+    def group_leave(self, connection: Connection, group_id: str):
+        group = self.member_group(connection, group_id)
+        if group is None:
+            return
+        username = group.clients.pop(connection)
+        self.broadcast(group, GroupLeaveEvent(username, group.id, group.long_name))
+
+    def message(self, connection: Connection, id: str):
+        message = self.public.messages.get(id)
+        if message is None:
+            return self.error(connection, "Message ID not found.")
+        connection.send(encode_event(MessageEvent(message[3])))
+
+    def group_message(self, connection: Connection, group_id: str, id: str):
+        group = self.member_group(connection, group_id)
+        if group is None:
+            return
+        message = group.messages.get(id)
+        if message is None:
+            return self.error(connection, "Message ID not found.")
+        connection.send(encode_event(MessageEvent(message[3])))
+
+    def list_groups(self, connection: Connection):
+        connection.send(encode_event(GroupsEvent([(id, self.groups[id].long_name) for id in sorted(self.groups)])))
+
+    def hello(self, connection: Connection, features: str):
+        extensions = frozenset(features.split(',')) & frozenset(EXTENSIONS)
+        connection.send(encode_event(HelloEvent(','.join(sorted(extensions)))))
+        connection.extensions = extensions
+
+    def disconnect(self, connection: Connection):
+        username = self.public.clients.pop(connection, None)
+        if username is not None:
+            self.broadcast(self.public, LeaveEvent(username))
+        for id in sorted(self.groups):
+            group = self.groups[id]
+            username = group.clients.pop(connection, None)
+            if username is not None:
+                self.broadcast(group, GroupLeaveEvent(username, group.id, group.long_name))
+
+async def run(host: str, port: int):
+    server = await BulletinServer().serve(host, port)
+    print(f"Listening on {host}:{port}", flush=True)
+    async with server:
+        await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Python reference server for the bulletin board protocol")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8083)
+    args = parser.parse_args()
+    try:
+        asyncio.run(run(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
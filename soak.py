@@ -0,0 +1,398 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import selectors
+import socket
+import sys
+import threading
+import time
+from collections import Counter
+
+from client import (
+    GROUP_JOIN, GROUP_POST, GROUPS, HEADER_SIZE, JOIN, MAX_FRAME_SIZE, POST, PUBLIC_GROUP, FrameDecoder, decode_frame,
+    encode_frame, percentiles,
+)
+
+# Broadcast fan-out soak test. Latency is read from time.monotonic_ns() in
+# each post's subject, which every process on the box shares.
+
+SUBJECT_PREFIX = 'soak@'
+RUN_TAG = f"{os.getpid()}.{time.monotonic_ns()}"
+DEFAULT_SIZES = '10,100,1000,10000'
+# leaf frames of a worker waiting for data, left out of the profile
+IDLE_LEAVES = frozenset({'selectors.py:select'})
+
+class Sampler:
+    # Counts the main thread's folded stacks, the input flamegraph.pl takes.
+    def __init__(self, interval: float, root: str):
+        self.interval = interval
+        self.root = root
+        self.stacks = Counter()
+        self.idle = 0
+        self.target = threading.main_thread().ident
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self) -> Counter:
+        self.stopping.set()
+        self.thread.join()
+        return self.stacks
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if names and names[0] in IDLE_LEAVES:
+                self.idle += 1
+                continue
+            names.append(self.root)
+            self.stacks[';'.join(reversed(names))] += 1
+
+class Session:
+    __slots__ = ('sock', 'decoder', 'ready')
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.decoder = FrameDecoder(MAX_FRAME_SIZE)
+        self.ready = False
+
+def raise_file_limit():
+    # every session is a descriptor, 10k members need more than the usual 1024
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def join_frames(group_id: str, username: str) -> bytes:
+    # GROUPS after the join is answered once the join has been handled
+    if group_id == PUBLIC_GROUP:
+        return bytes(encode_frame(JOIN, username) + encode_frame(GROUPS))
+    return bytes(encode_frame(GROUP_JOIN, group_id, username) + encode_frame(GROUPS))
+
+def post_frame(group_id: str, subject: str, body: str) -> bytes:
+    if group_id == PUBLIC_GROUP:
+        return bytes(encode_frame(POST, subject, body))
+    return bytes(encode_frame(GROUP_POST, group_id, subject, body))
+
+def parse_subject(subject: str, prefix: str):
+    # (stage, sequence number, send time in ns) from a soak post, else None
+    if not subject.startswith(prefix):
+        return None
+    stage, _, rest = subject[len(prefix):].partition(':')
+    seq, _, sent = rest.partition(':')
+    if not (stage.isdigit() and seq.isdigit() and sent.isdigit()):
+        return None
+    return int(stage), int(seq), int(sent)
+
+class Worker:
+    # reads the whole time, so the server never stalls its fan-out on us
+    def __init__(self, index: int, control, args: argparse.Namespace):
+        self.index = index
+        self.control = control
+        self.args = args
+        self.selector = selectors.DefaultSelector()
+        self.sessions = []
+        self.prefix = f"{SUBJECT_PREFIX}{RUN_TAG}:"
+        # stage -> [(sequence number, latency in ns)]
+        self.samples = {}
+        self.waiting = 0
+        self.lost = 0
+        self.failed = 0
+        self.malformed = 0
+        self.frames = 0
+
+    def run(self):
+        raise_file_limit()
+        sampler = None
+        if self.args.profile:
+            sampler = Sampler(self.args.profile_interval, f"worker{self.index}")
+            sampler.start()
+        while True:
+            if self.control.poll():
+                message = self.control.recv()
+                if message[0] == 'grow':
+                    self.grow(*message[1:])
+                elif message[0] == 'report':
+                    break
+            self.poll(0.05)
+        stacks = sampler.stop() if sampler is not None else Counter()
+        self.control.send({
+            'samples': self.samples,
+            'stacks': dict(stacks),
+            'idle_samples': sampler.idle if sampler is not None else 0,
+            'sessions': len(self.sessions),
+            'lost': self.lost,
+            'failed': self.failed,
+            'malformed': self.malformed,
+            'frames': self.frames,
+        })
+        for session in self.sessions:
+            session.sock.close()
+
+    def grow(self, names: list):
+        joining = []
+        failed = 0
+        for name in names:
+            try:
+                sock = socket.create_connection((self.args.host, self.args.port), timeout=self.args.timeout)
+                sock.sendall(join_frames(self.args.group, name))
+            except OSError:
+                failed += 1
+                continue
+            sock.setblocking(False)
+            session = Session(sock)
+            self.selector.register(sock, selectors.EVENT_READ, session)
+            self.sessions.append(session)
+            joining.append(session)
+            self.waiting += 1
+            # keep draining the members that are already in while the rest connect
+            self.poll(0)
+        deadline = time.monotonic() + self.args.timeout
+        while self.waiting and time.monotonic() < deadline:
+            self.poll(0.05)
+        # members that never got their join answered count as failed
+        joined = len(joining) - self.waiting
+        failed += self.waiting
+        self.failed += failed
+        self.waiting = 0
+        self.control.send(('ready', joined, failed))
+
+    def poll(self, timeout: float):
+        prefix = self.prefix
+        for key, _ in self.selector.select(timeout):
+            session = key.data
+            try:
+                count = session.decoder.recv_into(session.sock)
+            except BlockingIOError:
+                continue
+            except OSError:
+                count = 0
+            if count == 0:
+                self.selector.unregister(session.sock)
+                session.sock.close()
+                self.lost += 1
+                continue
+            received = time.monotonic_ns()
+            for frame in session.decoder.frames():
+                self.frames += 1
+                opcode = frame[HEADER_SIZE]
+                if opcode == GROUPS and not session.ready:
+                    session.ready = True
+                    self.waiting -= 1
+                    continue
+                # posts before the GROUPS answer are the join backlog
+                if opcode != POST and opcode != GROUP_POST or not session.ready:
+                    continue
+                event = decode_frame(frame)
+                if event is None:
+                    self.malformed += 1
+                    continue
+                tag = parse_subject(event.subject, prefix)
+                if tag is not None:
+                    self.samples.setdefault(tag[0], []).append((tag[1], received - tag[2]))
+
+def worker_main(index: int, control, args: argparse.Namespace):
+    Worker(index, control, args).run()
+
+class Sender:
+    # its own copies give the latency of a single delivery for comparison
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.prefix = f"{SUBJECT_PREFIX}{RUN_TAG}:"
+        self.sock = socket.create_connection((args.host, args.port), timeout=args.timeout)
+        self.sock.sendall(join_frames(args.group, f"{args.prefix}sender"))
+        self.sock.settimeout(None)
+        self.echoes = {}
+        self.body = 'x' * args.body_size
+        self.thread = threading.Thread(target=self.read, daemon=True)
+        self.thread.start()
+
+    def read(self):
+        decoder = FrameDecoder()
+        while True:
+            try:
+                count = decoder.recv_into(self.sock)
+            except OSError:
+                return
+            if count == 0:
+                return
+            received = time.monotonic_ns()
+            for frame in decoder.frames():
+                if frame[HEADER_SIZE] not in (POST, GROUP_POST):
+                    continue
+                event = decode_frame(frame)
+                tag = None if event is None else parse_subject(event.subject, self.prefix)
+                if tag is not None:
+                    self.echoes.setdefault(tag[0], []).append(received - tag[2])
+
+    def run_stage(self, stage: int, duration: float) -> int:
+        interval = 1.0 / self.args.rate
+        next_at = time.monotonic()
+        deadline = next_at + duration
+        seq = 0
+        while next_at < deadline:
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            subject = f"{self.prefix}{stage}:{seq}:{time.monotonic_ns()}"
+            self.sock.sendall(post_frame(self.args.group, subject, self.body))
+            seq += 1
+            next_at += interval
+        return seq
+
+    def close(self):
+        self.sock.close()
+
+def spread(samples: list) -> list:
+    # per post, first to last receiver in seconds: the time the fan-out loop took
+    first = {}
+    last = {}
+    for seq, latency in samples:
+        if seq not in first or latency < first[seq]:
+            first[seq] = latency
+        if seq not in last or latency > last[seq]:
+            last[seq] = latency
+    return [(last[seq] - first[seq]) / 1e9 for seq in first]
+
+def slope(points: list) -> float:
+    # least squares ms per 1000 members, None without two distinct sizes
+    if len({x for x, _ in points}) < 2:
+        return None
+    count = len(points)
+    mean_x = sum(x for x, _ in points) / count
+    mean_y = sum(y for _, y in points) / count
+    covariance = sum((x - mean_x) * (y - mean_y) for x, y in points)
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+    return covariance / variance * 1000
+
+def write_profile(path: str, stacks: Counter):
+    with open(path, 'w', encoding='utf-8') as profile:
+        for stack, count in stacks.most_common():
+            profile.write(f"{stack} {count}\n")
+
+def run(args: argparse.Namespace) -> dict:
+    raise_file_limit()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    stage_duration = args.duration / len(sizes)
+    context = multiprocessing.get_context('fork')
+    workers = []
+    for index in range(args.workers):
+        control, child = context.Pipe()
+        process = context.Process(target=worker_main, args=(index, child, args), daemon=True)
+        process.start()
+        workers.append((process, control))
+    sender = Sender(args)
+    members = 0
+    receivers = 0
+    stages = []
+    started = time.monotonic()
+    for stage, size in enumerate(sizes):
+        # new members are dealt out round robin so every worker grows evenly
+        names = [f"{args.prefix}{index}" for index in range(members, size)]
+        for index, (_, control) in enumerate(workers):
+            control.send(('grow', names[index::len(workers)]))
+        joined = failed = 0
+        for _, control in workers:
+            _, ok, bad = control.recv()
+            joined += ok
+            failed += bad
+        members = max(members, size)
+        receivers += joined
+        time.sleep(args.settle)
+        posts = sender.run_stage(stage, stage_duration)
+        stages.append({'stage': stage, 'members': size, 'receivers': receivers, 'join_failures': failed,
+                       'posts': posts})
+        print(f"stage {stage}: {size} members, {posts} posts", file=sys.stderr, flush=True)
+    time.sleep(args.drain)
+    reports = []
+    for _, control in workers:
+        control.send(('report',))
+    for process, control in workers:
+        reports.append(control.recv())
+        process.join(timeout=args.timeout)
+    sender.close()
+    elapsed = time.monotonic() - started
+    stacks = Counter()
+    for report in reports:
+        stacks.update(report['stacks'])
+    if args.profile:
+        write_profile(args.profile, stacks)
+    fit_last = []
+    fit_median = []
+    for entry in stages:
+        samples = [sample for report in reports for sample in report['samples'].get(entry['stage'], [])]
+        latencies = percentiles([latency / 1e9 for _, latency in samples])
+        expected = entry['posts'] * entry['receivers']
+        entry['delivered'] = len(samples)
+        entry['delivery_ratio'] = len(samples) / expected if expected else 0.0
+        entry['latency'] = latencies
+        entry['fanout_spread'] = percentiles(spread(samples))
+        entry['sender_echo'] = percentiles([latency / 1e9 for latency in sender.echoes.get(entry['stage'], [])])
+        if samples:
+            fit_last.append((entry['members'], latencies['max_ms']))
+            fit_median.append((entry['members'], latencies['p50_ms']))
+    return {
+        'config': {
+            'host': args.host,
+            'port': args.port,
+            'group': args.group,
+            'sizes': sizes,
+            'workers': args.workers,
+            'duration': args.duration,
+            'rate': args.rate,
+            'body_size': args.body_size,
+        },
+        'elapsed_s': elapsed,
+        'stages': stages,
+        # how much each extra 1000 members adds, a steady slope means linear fan-out
+        'growth_ms_per_1000_members': {'p50': slope(fit_median), 'max': slope(fit_last)},
+        'sessions': {
+            'open': sum(report['sessions'] for report in reports),
+            'lost': sum(report['lost'] for report in reports),
+            'failed': sum(report['failed'] for report in reports),
+        },
+        'frames': {
+            'received': sum(report['frames'] for report in reports),
+            'malformed': sum(report['malformed'] for report in reports),
+        },
+        'profile': args.profile,
+        'profile_samples': sum(stacks.values()),
+        'profile_idle_samples': sum(report['idle_samples'] for report in reports),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Multiprocess fan-out soak test for the bulletin board protocol")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8083)
+    parser.add_argument('--group', default=PUBLIC_GROUP, help="group the members join and the sender posts to")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help=f"members in each stage, default {DEFAULT_SIZES}")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="receiving processes")
+    parser.add_argument('--duration', type=float, default=40.0, help="seconds of posting, split evenly over the stages")
+    parser.add_argument('--rate', type=float, default=10.0, help="posts per second during a stage")
+    parser.add_argument('--body-size', type=int, default=64)
+    parser.add_argument('--settle', type=float, default=0.5, help="seconds to wait after a stage's members have joined")
+    parser.add_argument('--drain', type=float, default=2.0, help="seconds to keep receiving after the last post")
+    parser.add_argument('--timeout', type=float, default=30.0, help="seconds allowed for connecting and joining")
+    parser.add_argument('--prefix', default=f"soak{os.getpid()}-", help="username prefix")
+    parser.add_argument('--profile', help="write folded stacks of the workers' receive path here, for flamegraph.pl or speedscope")
+    parser.add_argument('--profile-interval', type=float, default=0.005, help="seconds between profile samples")
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+
+if __name__ == "__main__":
+    main()